@@ -1,15 +1,133 @@
+import argparse
 import sys
 from vm_translator import VMTranslator
+from call_optimizer import INLINE_THRESHOLD
+from pass_manager import OPT_LEVELS, PASSES
+from hack_assembler import OUTPUT_FORMATS
+from vm_ir import PROLOGUE_LOOP_MIN_LOCALS
+
+
+def add_translator_arguments(arg_parser, stats=True):
+    """Adds the translation flags, shared by every entry point that drives VMTranslator.
+
+    stats=False leaves out --stats, for entry points that never print the reports.
+    """
+    arg_parser.add_argument("--shared-calls", action="store_true",
+                            help="emit one shared $$CALL/$$RETURN routine instead of inlining them per call")
+    arg_parser.add_argument("--peephole", action="store_true",
+                            help="run the peephole optimiser on the assembly and report instructions removed per rule")
+    arg_parser.add_argument("--vm-optimize", action="store_true",
+                            help="fold constant arithmetic and fuse push/pop pairs before code generation")
+    arg_parser.add_argument("--shared-compare", action="store_true",
+                            help="emit one shared routine per comparison kind instead of inlining eq/gt/lt")
+    arg_parser.add_argument("--jobs", type=int, default=1,
+                            help="number of worker processes translating .vm files in parallel")
+    arg_parser.add_argument("--cache", action="store_true",
+                            help="reuse translations of unchanged .vm files from a .vmcache directory")
+    arg_parser.add_argument("--drop-dead-functions", action="store_true",
+                            help="omit functions unreachable from Sys.init (or the first function) and list them")
+    arg_parser.add_argument("--tos-cache", action="store_true",
+                            help="keep the top of the stack in D between commands of a basic block")
+    arg_parser.add_argument("--prologue-loop", type=int, nargs="?", const=PROLOGUE_LOOP_MIN_LOCALS, default=0,
+                            metavar="N",
+                            help="zero the locals of functions with at least N of them in a loop instead of unrolled "
+                                 f"(default N: {PROLOGUE_LOOP_MIN_LOCALS}, from where it is smaller; 2 cycles slower per local)")
+    arg_parser.add_argument("--segment-cache", action="store_true",
+                            help="reach small segment indexes with A=A+1 and reuse segment addresses and values "
+                                 "the previous push/pop left in A, D or R13")
+    arg_parser.add_argument("--tail-calls", action="store_true",
+                            help="let a call directly followed by return reuse the caller's frame")
+    arg_parser.add_argument("--thread-jumps", action="store_true",
+                            help="thread jump chains, invert branches over gotos, and drop unreachable code and "
+                                 "unused labels")
+    arg_parser.add_argument("--inline", type=int, nargs="?", const=INLINE_THRESHOLD, default=0, metavar="N",
+                            help=f"inline leaf functions whose body is at most N instructions "
+                                 f"(default N: {INLINE_THRESHOLD})")
+    arg_parser.add_argument("-O", dest="opt_level", choices=sorted(OPT_LEVELS), default="0",
+                            help="optimisation level: 0 translates as written, 1 runs the VM and peephole passes, "
+                                 "2 optimises for cycles, s for ROM size (adds to the flags above)")
+    arg_parser.add_argument("--passes", type=lambda text: [name for name in text.split(",") if name], metavar="PASS,...",
+                            help=f"run exactly these transformation passes, in this order ({', '.join(PASSES)})")
+    if stats:
+        arg_parser.add_argument("--stats", nargs="?", const="-", metavar="FILE",
+                                help="write stage timings and instruction counts as JSON to FILE (default: stdout)")
+    else:
+        arg_parser.set_defaults(stats=None)
+    arg_parser.add_argument("--profile", action="store_true",
+                            help="count each function's entries in RAM after the static variables (all must fit below "
+                                 "the stack at 256) and write a .profile.json symbol map for profiler.py")
+    arg_parser.add_argument("--profile-calls", action="store_true",
+                            help="like --profile, and also count the calls made at every call site")
+    arg_parser.add_argument("--source-map", action="store_true",
+                            help="write NAME.map.json next to the output, mapping ROM addresses to VM lines and "
+                                 "functions (see source_map.py)")
+    arg_parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default="asm",
+                            help="write Hack assembly (.asm), or assemble it in memory into machine code: "
+                                 ".hack text or packed 16-bit little-endian words (.bin)")
+
+
+def translator_options(args):
+    """Returns the VMTranslator keyword arguments the parsed flags ask for, -O level included"""
+    options = {
+        "shared_calls": args.shared_calls,
+        "peephole": args.peephole,
+        "vm_optimize": args.vm_optimize,
+        "shared_compare": args.shared_compare,
+        "dead_functions": args.drop_dead_functions,
+        "tos_cache": args.tos_cache,
+        "prologue_loop": args.prologue_loop,
+        "segment_cache": args.segment_cache,
+        "tail_calls": args.tail_calls,
+        "thread_jumps": args.thread_jumps,
+        "inline_threshold": args.inline
+    }
+    for name, value in OPT_LEVELS[args.opt_level].items():
+        options[name] = options[name] or value
+    return dict(options, jobs=args.jobs, cache=args.cache, passes=args.passes, stats=args.stats is not None,
+                profile=args.profile, profile_calls=args.profile_calls, output_format=args.format,
+                source_map=args.source_map)
+
+
+def print_reports(translator, args):
+    """Prints the reports of the passes and options a finished translation ran with"""
+    if translator.vm_optimizer:
+        print(translator.vm_optimizer.report(), file=sys.stderr)
+
+    if translator.call_optimizer:
+        print(translator.call_optimizer.report(), file=sys.stderr)
+
+    if translator.control_flow:
+        print(translator.control_flow.report(), file=sys.stderr)
+
+    if translator.peephole:
+        print(translator.peephole.report(), file=sys.stderr)
+
+    if args.cache:
+        print(translator.cache.report(), file=sys.stderr)
+
+    if translator.dead_functions:
+        print("\n".join(translator.dead_function_report), file=sys.stderr)
+
+    if translator.passes:
+        print(translator.pass_manager.report(), file=sys.stderr)
+
+    if args.stats == "-":
+        print(translator.stats_report())
+    elif args.stats:
+        with open(args.stats, 'w') as stats_file:
+            stats_file.write(translator.stats_report() + "\n")
 
 
 def main():
-    if len(sys.argv) != 2:
-        sys.exit(1)
+    arg_parser = argparse.ArgumentParser(description="Translates VM code into Hack assembly")
+    arg_parser.add_argument("input_path", help="a .vm file or a directory of .vm files")
+    add_translator_arguments(arg_parser)
+    args = arg_parser.parse_args()
 
-    input_path = sys.argv[1]
-    translator = VMTranslator(input_path)
+    translator = VMTranslator(args.input_path, **translator_options(args))
     translator.translate()
+    print_reports(translator, args)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,97 @@
+"""Translates many VM programs in one invocation, concurrently, and summarises each.
+
+Usage: python3 batch_translate.py [translation flags] [--recursive] [--workers N] PATH...
+Every .vm file and every directory of .vm files given is a program; with
+--recursive every directory below the given ones that holds .vm files is
+one too. Any other path, and a program that fails to translate, is
+reported as failed and does not stop the others. The translation flags
+are those of Main.py, but for --stats.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from Main import add_translator_arguments, translator_options
+from vm_translator import VMTranslator
+
+
+def has_vm_files(path):
+    return any(name.endswith(".vm") and os.path.isfile(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def find_programs(paths, recursive=False):
+    """Returns the programs (.vm files and directories of them) named by or, if recursive, below the paths"""
+    programs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            programs.append(path)
+        elif recursive:
+            for root, dirs, _ in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))  # Skips .vmcache
+                if has_vm_files(root):
+                    programs.append(root)
+        else:
+            programs.append(path)
+    return programs
+
+
+def translate_program(path, options):
+    """Translates one program and returns its summary as a dict (runs in worker processes)"""
+    start = time.perf_counter()
+    if not os.path.isdir(path) and not (path.endswith(".vm") and os.path.isfile(path)):
+        # The output would be written over the path itself
+        return {"path": path, "ok": False, "error": "not a .vm file or a directory", "ms": 0.0}
+    try:
+        translator = VMTranslator(path, **options)
+        translator.translate()
+    except Exception as error:  # Reported with the program, the rest of the batch carries on
+        return {"path": path, "ok": False, "error": f"{type(error).__name__}: {error}",
+                "ms": (time.perf_counter() - start) * 1000}
+    return {"path": path, "ok": True, "output": translator.output_file, "files": len(translator.input_files),
+            "ms": (time.perf_counter() - start) * 1000}
+
+
+def translate_batch(programs, options, workers):
+    """Translates the programs on at most workers processes, returns their summaries in program order"""
+    if workers <= 1 or len(programs) <= 1:
+        return [translate_program(path, options) for path in programs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Programs go to the workers in chunks, so thousands of small ones do not pay a round trip each
+        chunk_size = max(1, len(programs) // (workers * 8))
+        return list(executor.map(translate_program, programs, repeat(options), chunksize=chunk_size))
+
+
+def report(results, seconds):
+    """Returns one line per program, its failure if any, then the totals"""
+    lines = [f"{'program':<48}{'result':>8}{'files':>7}{'ms':>10}"]
+    for result in results:
+        status = "ok" if result["ok"] else "FAIL"
+        files = result.get("files", "")
+        lines.append(f"{result['path']:<48}{status:>8}{files:>7}{result['ms']:>10.1f}")
+        if not result["ok"]:
+            lines.append(f"  {result['error']}")
+    failed = sum(1 for result in results if not result["ok"])
+    lines.append(f"{len(results)} programs, {failed} failed, {seconds:.2f} s")
+    return "\n".join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("paths", nargs="+", help=".vm files and directories of .vm files")
+    arg_parser.add_argument("-r", "--recursive", action="store_true",
+                            help="translate every directory of .vm files below the given directories")
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="programs translated at once, each in its own process (default: CPU count)")
+    add_translator_arguments(arg_parser, stats=False)
+    args = arg_parser.parse_args()
+
+    start = time.perf_counter()
+    results = translate_batch(find_programs(args.paths, args.recursive), translator_options(args), args.workers)
+    print(report(results, time.perf_counter() - start))
+    sys.exit(1 if any(not result["ok"] for result in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
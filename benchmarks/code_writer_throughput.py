@@ -0,0 +1,96 @@
+"""Lines/second of CodeWriter on a large synthetic VM program, against the CodeWriter of a git revision.
+
+Usage: python3 benchmarks/code_writer_throughput.py [--commands N] [--baseline REV]
+The program is parsed once up front; only code generation and output are timed.
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+from parser import Parser  # noqa: E402
+from vm_translator import VMTranslator  # noqa: E402
+import code_writer  # noqa: E402
+
+COMMANDS = [
+    "push constant {i}",
+    "push local {i}",
+    "push argument {i}",
+    "add",
+    "pop that {i}",
+    "push static {i}",
+    "push temp {t}",
+    "sub",
+    "pop pointer {p}",
+    "push this {i}",
+    "not",
+    "pop static {i}",
+]
+
+
+def write_program(path, count):
+    """Writes count commands with small indexes, as compiled code uses them"""
+    with open(path, "w") as program:
+        for n in range(count):
+            program.write(COMMANDS[n % len(COMMANDS)].format(i=n % 16, t=n % 8, p=n % 2) + "\n")
+
+
+def load_code_writer(revision, work_dir):
+    """Imports code_writer.py as it was at a git revision"""
+    source = subprocess.run(["git", "-C", REPO_DIR, "show", f"{revision}:code_writer.py"],
+                            capture_output=True, text=True, check=True).stdout
+    path = os.path.join(work_dir, "baseline_code_writer.py")
+    with open(path, "w") as module_file:
+        module_file.write(source)
+    spec = importlib.util.spec_from_file_location("baseline_code_writer", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(writer_class, commands, output_path):
+    """Translates the commands with one CodeWriter class and returns (seconds, lines written)"""
+    translator = VMTranslator(output_path)
+    start = time.perf_counter()
+    translator.code_writer = writer_class(output_path)
+    translator.code_writer.setFileName("Bench")
+    for command in commands:
+        translator.write_command(command)
+    translator.code_writer.close()
+    elapsed = time.perf_counter() - start
+    with open(output_path) as output:
+        lines = sum(1 for _ in output)
+    return elapsed, lines
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--commands", type=int, default=2_000_000)
+    arg_parser.add_argument("--baseline", default="HEAD", help="git revision of the CodeWriter to compare against")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        program = os.path.join(work_dir, "Bench.vm")
+        write_program(program, args.commands)
+        commands = Parser(program).commands()
+        baseline = load_code_writer(args.baseline, work_dir)
+
+        print(f"{args.commands} commands")
+        print(f"{'writer':<20}{'seconds':>10}{'lines/s':>14}")
+        results = []
+        for name, writer_class in [(f"baseline {args.baseline}", baseline.CodeWriter),
+                                   ("working tree", code_writer.CodeWriter)]:
+            elapsed, lines = run(writer_class, commands, os.path.join(work_dir, "Bench.asm"))
+            results.append(lines / elapsed)
+            print(f"{name:<20}{elapsed:>10.3f}{lines / elapsed:>14,.0f}")
+        print(f"speedup {results[1] / results[0]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
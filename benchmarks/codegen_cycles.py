@@ -0,0 +1,57 @@
+"""ROM size and executed cycles of the test_dir programs, for two sets of translator flags.
+
+Usage: python3 benchmarks/codegen_cycles.py [--flags "--peephole ..."] [--baseline-flags "..."] [test_dir]
+Every program is translated into a scratch copy of the directory and run by hack_emulator.
+"""
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+from hack_emulator import find_tests, run_test  # noqa: E402
+
+
+def measure(test_dir, flags, work_dir):
+    """Translates every program under test_dir with the flags and returns {test name: TestResult}"""
+    copy = os.path.join(work_dir, "programs")
+    shutil.rmtree(copy, ignore_errors=True)
+    shutil.copytree(test_dir, copy)
+    results = {}
+    for tst_path in find_tests([copy]):
+        program_dir = os.path.dirname(tst_path)
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "Main.py"), program_dir] + shlex.split(flags),
+                       check=True, capture_output=True)
+        result = run_test(tst_path, os.path.join(program_dir, f"{os.path.basename(program_dir)}.asm"))
+        results[result.name] = result
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("test_dir", nargs="?", default=os.path.join(REPO_DIR, "test_dir"))
+    arg_parser.add_argument("--flags", default="", help="translator flags of the measured build")
+    arg_parser.add_argument("--baseline-flags", default="", help="translator flags to compare against")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        baseline = measure(args.test_dir, args.baseline_flags, work_dir)
+        measured = measure(args.test_dir, args.flags, work_dir)
+
+    print(f"baseline flags: '{args.baseline_flags}'  measured flags: '{args.flags}'")
+    print(f"{'program':<20}{'ok':>4}{'ROM':>12}{'cycles':>16}")
+    for name, result in measured.items():
+        before = baseline[name]
+        print(f"{name:<20}{'yes' if result.passed else 'NO':>4}"
+              f"{before.rom_size:>6}->{result.rom_size:<5}{before.cycles:>8}->{result.cycles:<7}")
+    failures = [name for name, result in measured.items() if not result.passed]
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""ROM size and cycles of unrolled against looped function prologues, across local counts.
+
+Usage: python3 benchmarks/function_prologue.py [--locals 0,1,2,...] [--calls N] [--flags "..."]
+For each local count a program calls a function with that many locals N
+times; it is translated with --prologue-loop 0 (unrolled) and 1 (always a
+loop) and run to its halt loop on hack_emulator's CPU.
+"""
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+from hack_assembler import assemble_file  # noqa: E402
+from hack_emulator import HackCPU  # noqa: E402
+
+MAX_CYCLES = 10_000_000
+
+
+def write_program(program_dir, n_locals, calls):
+    """Writes Sys.vm, which calls Main.f (a function with n_locals locals) calls times"""
+    with open(os.path.join(program_dir, "Sys.vm"), "w") as sys_vm:
+        sys_vm.write("function Sys.init 0\n")
+        sys_vm.write("call Main.f 0\npop temp 0\n" * calls)
+        sys_vm.write("label HALT\ngoto HALT\n")
+    with open(os.path.join(program_dir, "Main.vm"), "w") as main_vm:
+        main_vm.write(f"function Main.f {n_locals}\npush constant 1\nreturn\n")
+
+
+def measure(program_dir, flags):
+    """Translates the program with the flags and returns (ROM words, cycles to halt)"""
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, "Main.py"), program_dir] + flags,
+                   check=True, capture_output=True)
+    cpu = HackCPU(assemble_file(os.path.join(program_dir, f"{os.path.basename(program_dir)}.asm")))
+    cpu.run(MAX_CYCLES)
+    return cpu.rom_size, cpu.cycles
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--locals", default="0,1,2,3,4,8,16,32,50",
+                            help="comma-separated local counts to measure")
+    arg_parser.add_argument("--calls", type=int, default=10, help="calls made to the function")
+    arg_parser.add_argument("--flags", default="", help="other translator flags of both builds")
+    args = arg_parser.parse_args()
+
+    print(f"{args.calls} calls per program, flags: '{args.flags}'")
+    print(f"{'locals':>6}{'ROM unrolled':>14}{'ROM loop':>10}{'cycles unrolled':>17}{'cycles loop':>13}")
+    with tempfile.TemporaryDirectory() as work_dir:
+        program_dir = os.path.join(work_dir, "Prologue")
+        os.mkdir(program_dir)
+        for n_locals in [int(count) for count in args.locals.split(",")]:
+            write_program(program_dir, n_locals, args.calls)
+            unrolled = measure(program_dir, shlex.split(args.flags) + ["--prologue-loop", "0"])
+            loop = measure(program_dir, shlex.split(args.flags) + ["--prologue-loop", "1"])
+            print(f"{n_locals:>6}{unrolled[0]:>14}{loop[0]:>10}{unrolled[1]:>17}{loop[1]:>13}")
+
+
+if __name__ == "__main__":
+    main()
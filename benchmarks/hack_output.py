@@ -0,0 +1,71 @@
+"""End-to-end time to machine code: --format hack/packed against writing .asm and assembling it afterwards.
+
+Usage: python3 benchmarks/hack_output.py [--commands N]
+Also times loading each program format back, as hack_emulator does, and
+checks that every route produces the same machine words.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+from code_writer_throughput import write_program  # noqa: E402
+from hack_assembler import assemble_file, load_program, write_hack  # noqa: E402
+from vm_translator import VMTranslator  # noqa: E402
+
+
+def translate(program, output_format):
+    """Translates the program straight to one output format, returns (seconds, output path)"""
+    start = time.perf_counter()
+    translator = VMTranslator(program, output_format=output_format)
+    translator.translate()
+    return time.perf_counter() - start, translator.output_file
+
+
+def translate_then_assemble(program):
+    """Writes .asm, then assembles it into .hack as a separate step, returns (seconds, .hack path)"""
+    start = time.perf_counter()
+    _, asm_path = translate(program, "asm")
+    hack_path = os.path.splitext(asm_path)[0] + ".external.hack"
+    write_hack(hack_path, assemble_file(asm_path))
+    return time.perf_counter() - start, hack_path
+
+
+def timed_load(path):
+    start = time.perf_counter()
+    words = list(load_program(path))
+    return time.perf_counter() - start, words
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--commands", type=int, default=200_000)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        program = os.path.join(work_dir, "Bench.vm")
+        write_program(program, args.commands)
+
+        routes = [(".asm + assembler", translate_then_assemble(program)),
+                  ("--format hack", translate(program, "hack")),
+                  ("--format packed", translate(program, "packed"))]
+        print(f"{args.commands} commands")
+        print(f"{'route':<20}{'translate s':>12}{'load s':>10}{'words':>10}")
+        programs = []
+        for name, (elapsed, path) in routes:
+            load_seconds, words = timed_load(path)
+            programs.append(words)
+            print(f"{name:<20}{elapsed:>12.3f}{load_seconds:>10.3f}{len(words):>10}")
+        print(f"speedup {routes[0][1][0] / routes[1][1][0]:.2f}x (hack), "
+              f"{routes[0][1][0] / routes[2][1][0]:.2f}x (packed)")
+        if any(words != programs[0] for words in programs):
+            print("machine code differs between routes")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Peak RSS of parsing a large synthetic VM file: whole-file readlines vs the streaming Parser.
+
+Usage: python3 benchmarks/parser_memory.py [--translate] [number_of_commands]
+Each mode runs in a fresh interpreter so its peak RSS is measured on its own.
+With --translate the whole translation (streaming, one job, no cache) is
+measured instead, at 1/8, 1/4, 1/2 and all of the commands, and the run
+exits 1 unless peak RSS grows by less than TRANSLATE_GROWTH_LIMIT times the
+input file does, which holding the input or output in memory exceeds.
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from parser import Parser  # noqa: E402
+from vm_translator import VMTranslator  # noqa: E402
+
+MODES = ["readlines", "stream", "mmap"]
+TRANSLATE_FRACTIONS = [8, 4, 2, 1]  # --translate sizes, as divisors of the number of commands
+TRANSLATE_GROWTH_LIMIT = 0.5  # Largest peak RSS growth allowed per byte of input growth
+COMMANDS = [
+    "push constant 17",
+    "push local 0",
+    "add",
+    "pop argument 1",
+    "label LOOP",
+    "if-goto LOOP",
+    "call Main.run 2",
+]
+
+
+def write_program(path, count):
+    """Writes count commands, one per line, cycling through COMMANDS"""
+    with open(path, "w") as program:
+        for i in range(count):
+            program.write(COMMANDS[i % len(COMMANDS)] + "  // comment\n")
+
+
+def parse(path, mode):
+    """Parses (or translates) the file the way the given mode does and returns the number of commands"""
+    if mode == "readlines":
+        # What Parser did before streaming: the whole file as a list of lines, then a list of commands
+        with open(path) as source:
+            lines = source.readlines()
+        parser = Parser(path)
+        parser.close()
+        parser.source = iter(lines)
+        parser.next_line = next(parser.source, None)
+        return len(parser.commands())
+    if mode == "translate":
+        VMTranslator(path, jobs=1, cache=False).translate()
+        with open(path) as source:
+            return sum(1 for _ in source)  # One command per line
+    parser = Parser(path, use_mmap=mode == "mmap")
+    return sum(1 for _ in parser.iter_commands())
+
+
+def measure(path, mode):
+    """Runs one mode in this process and prints: mode, commands, seconds, peak RSS in KiB"""
+    start = time.perf_counter()
+    count = parse(path, mode)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{mode} {count} {elapsed:.3f} {peak}")
+
+
+def run_mode(path, mode):
+    """Returns (seconds, peak RSS in KiB) of one mode, run in a fresh interpreter"""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", path, mode],
+                            capture_output=True, text=True, check=True).stdout.split()
+    return float(output[2]), int(output[3])
+
+
+def check_translation(count, work_dir):
+    """Prints the peak RSS of translating growing inputs and returns true if it grows sublinearly"""
+    print(f"{'commands':>10}{'input MiB':>12}{'seconds':>10}{'peak RSS MiB':>16}")
+    runs = []
+    for fraction in TRANSLATE_FRACTIONS:
+        path = os.path.join(work_dir, f"Large{fraction}.vm")
+        write_program(path, count // fraction)
+        seconds, peak = run_mode(path, "translate")
+        runs.append((os.path.getsize(path), peak))
+        print(f"{count // fraction:>10}{runs[-1][0] / 2 ** 20:>12.1f}{seconds:>10.3f}{peak / 1024:>16.1f}")
+    (first_size, first_peak), (last_size, last_peak) = runs[0], runs[-1]
+    growth = (last_peak - first_peak) * 1024 / (last_size - first_size)
+    print(f"peak RSS grew {growth:.3f} bytes per input byte (limit {TRANSLATE_GROWTH_LIMIT})")
+    return growth < TRANSLATE_GROWTH_LIMIT
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+        return
+
+    translate = "--translate" in sys.argv[1:]
+    counts = [arg for arg in sys.argv[1:] if arg != "--translate"]
+    count = int(counts[0]) if counts else 2_000_000
+    with tempfile.TemporaryDirectory() as work_dir:
+        if translate:
+            sys.exit(0 if check_translation(count, work_dir) else 1)
+        path = os.path.join(work_dir, "Large.vm")
+        write_program(path, count)
+        print(f"{os.path.getsize(path) / 2 ** 20:.1f} MiB, {count} commands")
+        print(f"{'mode':<12}{'seconds':>10}{'peak RSS MiB':>16}")
+        for mode in MODES:
+            seconds, peak = run_mode(path, mode)
+            print(f"{mode:<12}{seconds:>10.3f}{peak / 1024:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Regression benchmark of the code generator over a fixed corpus, compared with the previous recorded run.
+
+Usage: python3 benchmarks/regression.py [--history FILE] [--record] [--commands N]
+For each optimisation level the corpus (the test_dir programs and a fixed
+set of vm_fuzz programs) is translated and run: every test_dir program must
+match its .cmp file and every fuzz program the interpreter, and the total
+ROM words and executed cycles are measured, along with translation
+throughput on a large synthetic file. The run is compared with the last
+entry of the history file (one JSON record per line); --record appends it.
+Exits 1 on a correctness failure, more ROM or cycles, or throughput under
+the level's THROUGHPUT_FLOORS; throughput more than THROUGHPUT_TOLERANCE
+below a recorded run of the same --commands is only a warning, timings
+being noisy.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+from code_writer_throughput import write_program  # noqa: E402
+from hack_emulator import find_tests, run_test  # noqa: E402
+from vm_fuzz import ProgramGenerator, parse_flags, reference_state, translated_state  # noqa: E402
+from vm_translator import VMTranslator  # noqa: E402
+
+LEVELS = ["-O0", "-O1", "-O2", "-Os"]
+CORPUS_SEEDS = range(1000, 1040)  # Fuzz programs of the fixed corpus; changing them resets the history
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regression_history.jsonl")
+THROUGHPUT_TOLERANCE = 0.25  # Timing noise allowed before slower translation is warned about
+# Fewest commands/s each level must translate, well below what it does (-O0 ~110k, the others ~9k)
+THROUGHPUT_FLOORS = {"-O0": 40_000, "-O1": 3_000, "-O2": 3_000, "-Os": 3_000}
+
+
+def measure_level(flags, corpus_dir, throughput_program):
+    """Returns the metrics of one optimisation level over the corpus"""
+    options = parse_flags(flags)
+    failures, rom, cycles = [], 0, 0
+
+    for tst_path in find_tests([os.path.join(corpus_dir, "test_dir")]):
+        program_dir = os.path.dirname(tst_path)
+        translator = VMTranslator(program_dir, **options)
+        translator.translate()
+        result = run_test(tst_path, translator.output_file)
+        rom += result.rom_size
+        cycles += result.cycles
+        if not result.passed:
+            failures.append(result.name)
+
+    for seed in CORPUS_SEEDS:
+        program_dir = os.path.join(corpus_dir, f"Fuzz{seed}")
+        expected, _ = reference_state(program_dir)
+        try:
+            got, rom_size, program_cycles = translated_state(program_dir, options)
+        except RuntimeError:
+            failures.append(f"Fuzz{seed}")
+            continue
+        rom += rom_size
+        cycles += program_cycles
+        if got != expected:
+            failures.append(f"Fuzz{seed}")
+
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        VMTranslator(throughput_program, **options).translate()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    with open(throughput_program) as program:
+        commands = sum(1 for _ in program)
+    return {"failures": failures, "rom": rom, "cycles": cycles, "commands_per_s": round(commands / best)}
+
+
+def regressions(previous, current):
+    """Returns (what got worse since the previous record, slower translation) as messages"""
+    problems, warnings = [], []
+    for level, metrics in current["levels"].items():
+        before = previous["levels"].get(level)
+        if metrics["failures"]:
+            problems.append(f"{level}: wrong results for {', '.join(metrics['failures'])}")
+        if metrics["commands_per_s"] < THROUGHPUT_FLOORS[level]:
+            problems.append(f"{level}: throughput of {metrics['commands_per_s']} commands/s is under the floor "
+                            f"of {THROUGHPUT_FLOORS[level]}")
+        if before is None:
+            continue
+        for metric in ("rom", "cycles"):
+            if metrics[metric] > before[metric]:
+                problems.append(f"{level}: {metric} grew from {before[metric]} to {metrics[metric]}")
+        if current["commands"] == previous["commands"] and \
+                metrics["commands_per_s"] < before["commands_per_s"] * (1 - THROUGHPUT_TOLERANCE):
+            warnings.append(f"{level}: throughput fell from {before['commands_per_s']} "
+                            f"to {metrics['commands_per_s']} commands/s")
+    return problems, warnings
+
+
+def revision():
+    """Returns the checked-out git revision, marked when the working tree has changes"""
+    def git(*args):
+        return subprocess.run(["git", "-C", REPO_DIR] + list(args), capture_output=True, text=True).stdout.strip()
+    return git("rev-parse", "--short", "HEAD") + ("+dirty" if git("status", "--porcelain", "--untracked-files=no")
+                                                  else "")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON-lines file of earlier runs")
+    arg_parser.add_argument("--record", action="store_true", help="append this run to the history")
+    arg_parser.add_argument("--commands", type=int, default=100_000, help="size of the throughput program")
+    args = arg_parser.parse_args()
+
+    current = {"revision": revision(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commands": args.commands,
+               "levels": {}}
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        shutil.copytree(os.path.join(REPO_DIR, "test_dir"), os.path.join(corpus_dir, "test_dir"),
+                        ignore=shutil.ignore_patterns("*.asm"))
+        for seed in CORPUS_SEEDS:
+            os.makedirs(os.path.join(corpus_dir, f"Fuzz{seed}"))
+            ProgramGenerator(seed).write(os.path.join(corpus_dir, f"Fuzz{seed}"))
+        throughput_program = os.path.join(corpus_dir, "Bench.vm")
+        write_program(throughput_program, args.commands)
+        for level in LEVELS:
+            current["levels"][level] = measure_level(level, corpus_dir, throughput_program)
+
+    previous = None
+    if os.path.exists(args.history):
+        with open(args.history) as history:
+            records = [json.loads(line) for line in history if line.strip()]
+        previous = records[-1] if records else None
+
+    print(f"revision {current['revision']}" + (f", compared with {previous['revision']}" if previous else ""))
+    print(f"{'level':<8}{'ok':>4}{'ROM':>16}{'cycles':>20}{'commands/s':>24}")
+    for level, metrics in current["levels"].items():
+        before = previous["levels"].get(level) if previous else None
+
+        def cell(metric):
+            return f"{before[metric]}->{metrics[metric]}" if before else f"{metrics[metric]}"
+        ok = "no" if metrics["failures"] else "yes"
+        print(f"{level:<8}{ok:>4}{cell('rom'):>16}{cell('cycles'):>20}{cell('commands_per_s'):>24}")
+
+    problems, warnings = regressions(previous or {"commands": None, "levels": {}}, current)
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    for warning in warnings:
+        print(f"warning {warning}")
+    if args.record:
+        with open(args.history, "a") as history:
+            history.write(json.dumps(current) + "\n")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Differential fuzzing of the code generator against the VM interpreter.
+
+Usage: python3 benchmarks/vm_fuzz.py [--seeds N] [--first-seed S] [--flags "..." ...] [--keep DIR]
+Each seed generates a random well-formed, terminating multi-file VM program
+(arithmetic, every segment, branches, loops, calls). vm_interpreter runs it
+as the reference; every flag set translates it with VMTranslator and runs the
+assembly on hack_emulator's CPU. The final SP, LCL, ARG, THIS, THAT, temp,
+static and heap cells must agree. Failing programs are copied to --keep.
+"""
+import argparse
+import os
+import random
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+from Main import add_translator_arguments, translator_options  # noqa: E402
+from hack_assembler import HackAssembler  # noqa: E402
+from hack_emulator import HackCPU  # noqa: E402
+from vm_interpreter import VMInterpreter  # noqa: E402
+from vm_translator import VMTranslator  # noqa: E402
+
+FLAG_SETS = ["", "-O1", "-O2", "-Os", "--tos-cache", "--shared-calls --shared-compare", "--inline --tail-calls",
+             "--thread-jumps --prologue-loop 1", "--segment-cache", "--segment-cache --tos-cache --vm-optimize",
+             "-O2 --jobs 2"]
+
+FILES = ["Sys", "Main", "Util"]
+STEP_BUDGET = 20_000  # Most VM commands a generated program executes
+MAX_CYCLES = 5_000_000
+HEAP_START, HEAP_END = 3000, 5000  # THIS and THAT point into this range
+STATIC_SYMBOL = re.compile(r"^[A-Za-z_][\w]*\.\d+$")  # "File.index", as opposed to function and label names
+
+
+class ProgramGenerator:
+    """Writes a random program whose functions only call earlier ones, with bounded loops, so it always halts.
+
+    The cost of every function (VM commands per call, loops and callees
+    included) is tracked while generating, and calls or loops that would
+    push the program over STEP_BUDGET are not generated.
+    """
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.functions = []  # (file, name, nArgs, cost) of the functions generated so far
+        self.labels = 0
+        self.lines = None  # Lines of the function being generated
+        self.cost = 0
+        self.multiplier = 1  # Iterations of the loops around the code being generated
+
+    def emit(self, *lines):
+        self.lines.extend(lines)
+        self.cost += self.multiplier * len(lines)
+
+    def label(self):
+        self.labels += 1
+        return f"L{self.labels}"
+
+    def write(self, program_dir):
+        sources = {name: [] for name in FILES}
+        for _ in range(self.rng.randint(2, 7)):
+            filename = self.rng.choice(FILES[1:])
+            sources[filename] += self.function(filename, f"{filename}.f{len(self.functions)}",
+                                               self.rng.randint(0, 3), self.rng.randint(0, 4))
+        sources["Sys"] = self.function("Sys", "Sys.init", 0, self.rng.randint(0, 3), entry=True)
+        for filename, lines in sources.items():
+            with open(os.path.join(program_dir, f"{filename}.vm"), "w") as source:
+                source.write("\n".join(lines) + "\n")
+
+    def function(self, filename, name, n_args, n_locals, entry=False):
+        """Returns the lines of one function; its locals past n_locals are loop counters"""
+        self.lines, self.cost, self.multiplier = [], 0, 1
+        self.labels = 0  # Labels are local to their function, so every function reuses L1, L2, ...
+        self.filename, self.n_args, self.n_locals, self.loop_depth = filename, n_args, n_locals, 0
+        self.emit(f"function {name} {n_locals + 2}")
+        if entry:
+            self.emit("push constant 3000", "pop pointer 0", "push constant 4000", "pop pointer 1")
+        for _ in range(self.rng.randint(1, 6)):
+            self.statement(depth=0)
+        if entry:
+            for index in range(3):
+                self.expression(depth=0)
+                self.emit(f"pop static {index}")
+            self.emit("label HALT", "goto HALT")
+        else:
+            self.expression(depth=0)
+            self.emit("return")
+            self.functions.append((filename, name, n_args, self.cost))
+        return self.lines
+
+    def cell(self, writable):
+        """Returns a random "segment index" the current function may read (or write)"""
+        choices = ["temp", "static", "this", "that"]
+        if self.n_locals:
+            choices.append("local")
+        if self.n_args:
+            choices.append("argument")
+        if not writable:
+            choices += ["constant", "constant"]
+        segment = self.rng.choice(choices)
+        limit = {"temp": 8, "static": 6, "this": 8, "that": 8, "local": self.n_locals, "argument": self.n_args}
+        if segment == "constant":
+            return f"constant {self.rng.choice([0, 1, 2, self.rng.randint(0, 32767)])}"
+        return f"{segment} {self.rng.randrange(limit[segment])}"
+
+    def expression(self, depth):
+        """Emits code that pushes exactly one value"""
+        kind = self.rng.random()
+        if depth >= 3 or kind < 0.4:
+            self.emit(f"push {self.cell(writable=False)}")
+        elif kind < 0.55:
+            self.expression(depth + 1)
+            self.emit(self.rng.choice(["neg", "not"]))
+        elif kind < 0.85 or not self.call(depth):
+            self.expression(depth + 1)
+            self.expression(depth + 1)
+            self.emit(self.rng.choice(["add", "sub", "and", "or", "eq", "gt", "lt"]))
+
+    def call(self, depth):
+        """Emits a call to an earlier function if the budget allows one; returns whether it did"""
+        affordable = [f for f in self.functions if self.multiplier * f[3] + self.cost < STEP_BUDGET // 4]
+        if not affordable:
+            return False
+        _, name, n_args, cost = self.rng.choice(affordable)
+        for _ in range(n_args):
+            self.expression(depth + 1)
+        self.emit(f"call {name} {n_args}")
+        self.cost += self.multiplier * cost
+        return True
+
+    def statement(self, depth):
+        kind = self.rng.random()
+        if depth >= 2 or kind < 0.5:
+            self.expression(depth=1)
+            self.emit(f"pop {self.cell(writable=True)}")
+        elif kind < 0.6:
+            self.emit(f"push constant {self.rng.choice([HEAP_START, HEAP_START + 500])}",
+                      f"pop pointer {self.rng.randint(0, 1)}")
+        elif kind < 0.8:
+            else_label, end_label = self.label(), self.label()
+            self.expression(depth=1)
+            self.emit(f"if-goto {else_label}")
+            self.block(depth)
+            self.emit(f"goto {end_label}", f"label {else_label}")
+            self.block(depth)
+            self.emit(f"label {end_label}")
+        elif self.loop_depth < 2:
+            self.loop(depth)
+
+    def block(self, depth):
+        for _ in range(self.rng.randint(0, 3)):
+            self.statement(depth + 1)
+
+    def loop(self, depth):
+        """Emits a loop counting down a reserved local from a small constant"""
+        counter = f"local {self.n_locals + self.loop_depth}"
+        iterations = self.rng.randint(0, 4)
+        top, end = self.label(), self.label()
+        self.emit(f"push constant {iterations}", f"pop {counter}", f"label {top}",
+                  f"push {counter}", "push constant 0", "eq", f"if-goto {end}")
+        self.loop_depth += 1
+        self.multiplier *= max(iterations, 1)
+        self.block(depth)
+        self.emit(f"push {counter}", "push constant 1", "sub", f"pop {counter}", f"goto {top}")
+        self.multiplier //= max(iterations, 1)
+        self.loop_depth -= 1
+        self.emit(f"label {end}")
+
+
+def final_state(ram, statics):
+    """Returns the cells every translation must agree on, given the RAM and {"File.index": address}"""
+    state = {name: ram[address] for name, address in zip(["SP", "LCL", "ARG", "THIS", "THAT"], range(5))}
+    state.update({f"temp {i}": ram[5 + i] for i in range(8)})
+    state.update({name: ram[address] for name, address in statics.items() if ram[address]})
+    state.update({f"RAM[{address}]": ram[address] for address in range(HEAP_START, HEAP_END) if ram[address]})
+    return state
+
+
+def reference_state(program_dir):
+    interpreter = VMInterpreter(program_dir)
+    interpreter.run(STEP_BUDGET * 4)
+    if not interpreter.halted:
+        raise RuntimeError("the interpreter did not halt")
+    return final_state(interpreter.ram, interpreter.statics), interpreter.cycles
+
+
+def translated_state(program_dir, options):
+    """Translates the program with VMTranslator options, runs it on the CPU, returns (state, ROM, cycles)"""
+    translator = VMTranslator(program_dir, **options)
+    translator.translate()
+    assembler = HackAssembler()
+    with open(translator.output_file) as output:
+        words = assembler.assemble(output)
+    cpu = HackCPU(words)
+    cpu.run(MAX_CYCLES)
+    if not cpu.halted:
+        raise RuntimeError(f"the program did not halt within {MAX_CYCLES} cycles")
+    statics = {name: address for name, address in assembler.symbols.items() if STATIC_SYMBOL.match(name)}
+    return final_state(cpu.ram, statics), cpu.rom_size, cpu.cycles
+
+
+def parse_flags(flags):
+    """Returns the VMTranslator options of a Main.py flag string"""
+    arg_parser = argparse.ArgumentParser()
+    add_translator_arguments(arg_parser)
+    return translator_options(arg_parser.parse_args(shlex.split(flags)))
+
+
+def check_seed(seed, flag_sets, work_dir):
+    """Generates and checks one program; returns a list of (flags, problem) mismatches"""
+    program_dir = os.path.join(work_dir, f"Fuzz{seed}")
+    shutil.rmtree(program_dir, ignore_errors=True)
+    os.makedirs(program_dir)
+    ProgramGenerator(seed).write(program_dir)
+    expected, _ = reference_state(program_dir)
+    problems = []
+    for flags in flag_sets:
+        try:
+            got, _, _ = translated_state(program_dir, parse_flags(flags))
+        except Exception as error:  # Reported as a mismatch of this flag set, the rest still run
+            problems.append((flags, f"{type(error).__name__}: {error}"))
+            continue
+        differences = {key: (got.get(key, 0), expected.get(key, 0)) for key in set(got) | set(expected)
+                       if got.get(key, 0) != expected.get(key, 0)}
+        if differences:
+            shown = ", ".join(f"{key}: got {g}, expected {e}" for key, (g, e) in sorted(differences.items())[:5])
+            problems.append((flags, shown))
+    return problems
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--seeds", type=int, default=50, help="number of programs to generate")
+    arg_parser.add_argument("--first-seed", type=int, default=0)
+    arg_parser.add_argument("--flags", action="append", help=f"translator flag sets to check (default: {FLAG_SETS})")
+    arg_parser.add_argument("--keep", metavar="DIR", help="copy failing programs here")
+    args = arg_parser.parse_args()
+
+    flag_sets = args.flags or FLAG_SETS
+    failures = 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        for seed in range(args.first_seed, args.first_seed + args.seeds):
+            problems = check_seed(seed, flag_sets, work_dir)
+            for flags, problem in problems:
+                print(f"seed {seed} flags '{flags}': {problem}")
+            if problems:
+                failures += 1
+                if args.keep:
+                    shutil.copytree(os.path.join(work_dir, f"Fuzz{seed}"), os.path.join(args.keep, f"Fuzz{seed}"),
+                                    dirs_exist_ok=True)
+    print(f"{args.seeds} programs, {len(flag_sets)} flag sets, {failures} failing programs")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from vm_ir import Opcode
+
+
+def split_functions(commands):
+    """Yields (function name, command) pairs; commands before the first function belong to None"""
+    function_name = None
+    for command in commands:
+        if command.op == Opcode.FUNCTION:
+            function_name = command.name
+        yield function_name, command
+
+
+def drop_dead_functions(commands, live_functions):
+    """Yields the commands of live functions and of top-level code only"""
+    for function_name, command in split_functions(commands):
+        if function_name is None or function_name in live_functions:
+            yield command
+
+
+class CallGraph:
+    """Functions defined across a program's files and the functions each one calls"""
+
+    def __init__(self):
+        self.files = {}  # function name -> defining .vm file
+        self.calls = {}  # function name -> set of called function names
+        self.entry_points = []  # First function of each file, in file order
+        self.top_level_calls = set()  # Calls made by code outside any function
+
+    def add_file(self, input_file, commands):
+        """Records the functions a file defines and the calls they make"""
+        first = True
+        for function_name, command in split_functions(commands):
+            if command.op == Opcode.FUNCTION:
+                self.files[command.name] = input_file
+                self.calls.setdefault(command.name, set())
+                if first:
+                    self.entry_points.append(command.name)
+                    first = False
+            elif command.op == Opcode.CALL:
+                if function_name is None:
+                    self.top_level_calls.add(command.name)
+                else:
+                    self.calls[function_name].add(command.name)
+
+    def reachable(self, roots):
+        """Returns the set of defined functions reachable from the roots"""
+        live = set()
+        pending = [root for root in roots if root in self.files]
+        while pending:
+            function_name = pending.pop()
+            if function_name in live:
+                continue
+            live.add(function_name)
+            pending.extend(callee for callee in self.calls[function_name] if callee in self.files)
+        return live
@@ -0,0 +1,142 @@
+from parser import parse_line
+from vm_ir import Command, Opcode, Segment, ARITHMETIC_OPS, UNARY_OPS
+
+INLINE_THRESHOLD = 48  # Default largest body, in generated instructions, of a function inlined at its call sites
+
+
+def stack_effect(command):
+    """Returns how many values a push, pop or arithmetic command adds to the stack"""
+    if command.op == Opcode.PUSH:
+        return 1
+    if command.op == Opcode.POP or (command.op in ARITHMETIC_OPS and command.op not in UNARY_OPS):
+        return -1
+    return 0
+
+
+def inlinable(function):
+    """Returns true if a function's commands (from its function command on) are straight-line leaf code
+    that ends in its only return and never pops below its own locals"""
+    if len(function) < 2 or function[-1].op != Opcode.RETURN:
+        return False
+    depth = 0
+    for command in function[1:-1]:
+        if command.op not in ARITHMETIC_OPS and command.op not in (Opcode.PUSH, Opcode.POP):
+            return False
+        if command.segment == Segment.LOCAL and command.index >= function[0].index:
+            return False
+        depth += stack_effect(command)
+        if depth < 0:
+            return False
+    return depth >= 1
+
+
+class CallOptimizer:
+    """Rewrites the calls of a file's Commands before code generation.
+
+    A call directly followed by return becomes a tail call that reuses the
+    caller's frame. A call to a small leaf function is replaced by the
+    function's body, which then reaches its arguments and locals relative to
+    the stack top instead of through a frame.
+    """
+
+    def __init__(self, inline_functions=None):
+        # name -> {"file", "locals", "arguments", "body"} of each function inlined at its call sites
+        self.inline_functions = inline_functions or {}
+        self.bodies = {}  # name -> parsed body Commands
+        self.applied = {"inline": 0, "tail call": 0}  # Call sites rewritten by each optimisation
+
+    def inline_calls(self, commands, filename):
+        """Replaces the calls to inlined functions in the file filename with their bodies"""
+        for command in commands:
+            if command.op == Opcode.CALL:
+                function = self.inline_functions.get(command.name)
+                if function is not None and function["arguments"] <= command.index:
+                    yield from self.inline(command, function, filename)
+                    self.applied["inline"] += 1
+                    continue
+            yield command
+
+    def mark_tail_calls(self, commands):
+        """Replaces each call inside a function that is directly followed by return with a tail call"""
+        pending = None  # A call that becomes a tail call if the next command returns
+        in_function = False
+        for command in commands:
+            if pending is not None:
+                if command.op == Opcode.RETURN:
+                    yield Command(Opcode.TAIL_CALL, name=pending.name, index=pending.index,
+                                  line_number=pending.line_number)
+                    self.applied["tail call"] += 1
+                    pending = None
+                    continue
+                yield pending
+                pending = None
+            if command.op == Opcode.FUNCTION:
+                in_function = True
+            elif command.op == Opcode.CALL and in_function:
+                pending = command
+                continue
+            yield command
+        if pending is not None:
+            yield pending
+
+    def body(self, name):
+        """Returns the parsed body of an inlined function"""
+        if name not in self.bodies:
+            self.bodies[name] = [parse_line(line) for line in self.inline_functions[name]["body"]]
+        return self.bodies[name]
+
+    def inline(self, call, function, filename):
+        """Yields the body of a leaf function in place of a call to it.
+
+        The caller's arguments stay where the call left them and the locals
+        are pushed above them, so every argument and local is a fixed
+        distance below the stack top. Pointers the body sets are saved above
+        the locals and restored before returning, as a frame would.
+        """
+        n_args = call.index
+        n_locals = function["locals"]
+        scope = function["file"] if function["file"] != filename else None  # Owner of the body's static cells
+        body = self.body(call.name)
+        saved = sorted({c.index for c in body if c.op == Opcode.POP and c.segment == Segment.POINTER})
+
+        def at(command, segment, index):
+            return Command(command.op, segment, index, line_number=call.line_number)
+
+        push, pop = Command(Opcode.PUSH), Command(Opcode.POP)
+        depth = 0  # Values above the arguments
+        for _ in range(n_locals):
+            yield at(push, Segment.CONSTANT, 0)
+            depth += 1
+        for pointer in saved:
+            yield at(push, Segment.POINTER, pointer)
+            depth += 1
+        for command in body:
+            # Values below the moved one: the stack before a push, or after a pop
+            below = depth if command.op == Opcode.PUSH else depth - 1
+            if command.segment == Segment.ARGUMENT:
+                yield at(command, Segment.STACK, below + n_args - 1 - command.index)
+            elif command.segment == Segment.LOCAL:
+                yield at(command, Segment.STACK, below - 1 - command.index)
+            elif command.segment == Segment.STATIC:
+                yield Command(command.op, Segment.STATIC, command.index, name=scope, line_number=call.line_number)
+            elif command.op in (Opcode.PUSH, Opcode.POP):
+                yield at(command, command.segment, command.index)
+            else:
+                yield Command(command.op, line_number=call.line_number)
+            depth += stack_effect(command)
+
+        for position, pointer in enumerate(saved):
+            yield at(push, Segment.STACK, depth - 1 - n_locals - position)
+            yield at(pop, Segment.POINTER, pointer)
+
+        # Move the return value to the first argument's cell and drop everything above it
+        below = depth + n_args - 2
+        if below >= 0:
+            yield at(pop, Segment.STACK, below)
+            yield Command(Opcode.DROP, index=below, line_number=call.line_number)
+
+    def report(self):
+        """Returns one line per optimisation with the number of call sites it rewrote"""
+        lines = [f"{name:<16}{count:>8}" for name, count in self.applied.items()]
+        lines.append(f"{'total':<16}{sum(self.applied.values()):>8}")
+        return "\n".join(lines)
@@ -1,58 +1,489 @@
+from functools import lru_cache
+from time import perf_counter
+from pass_manager import is_instruction
+from hack_assembler import HackAssembler, write_hack, write_packed
+from source_map import SourceMap, source_mark, source_map_path
+from vm_ir import scoped_label
+
+FLUSH_LINES = 8192  # Lines buffered before a single write to the output file
+RENDER_CACHE_SIZE = 4096  # Rendered push/pop snippets kept by render_push_pop
+
+# Templates for the commands that take no arguments, rendered once
+ARITHMETIC_TEMPLATES = {
+    "add": (
+        "@SP",  # Get stack pointer
+        "AM=M-1",  # Decrement SP and get address
+        "D=M",  # D = y
+        "A=A-1",  # Point to x
+        "M=D+M"  # x + y
+    ),
+    "sub": (
+        "@SP",  # Get stack pointer
+        "AM=M-1",  # Decrement SP and get address
+        "D=M",  # D = y
+        "A=A-1",  # Point to x
+        "M=M-D"  # x - y
+    ),
+    "neg": (
+        "@SP",  # Get stack pointer
+        "A=M-1",  # Point to top of stack
+        "M=-M"  # Negate value
+    ),
+    "and": (
+        "@SP",  # Get stack pointer
+        "AM=M-1",  # Decrement SP and get address
+        "D=M",  # D = y
+        "A=A-1",  # Point to x
+        "M=D&M"  # x AND y
+    ),
+    "or": (
+        "@SP",  # Get stack pointer
+        "AM=M-1",  # Decrement SP and get address
+        "D=M",  # D = y
+        "A=A-1",  # Point to x
+        "M=D|M"  # x OR y
+    ),
+    "not": (
+        "@SP",  # Get stack pointer
+        "A=M-1",  # Point to top of stack
+        "M=!M"  # NOT x
+    )
+}
+
+# Top-of-stack cache variants: the stack top is in D and is not counted by SP
+CACHED_ARITHMETIC_TEMPLATES = {
+    "add": (
+        "@SP",
+        "AM=M-1",  # Pop x
+        "D=D+M"  # D = x + y
+    ),
+    "sub": (
+        "@SP",
+        "AM=M-1",  # Pop x
+        "D=M-D"  # D = x - y
+    ),
+    "and": (
+        "@SP",
+        "AM=M-1",  # Pop x
+        "D=D&M"  # D = x AND y
+    ),
+    "or": (
+        "@SP",
+        "AM=M-1",  # Pop x
+        "D=D|M"  # D = x OR y
+    ),
+    "neg": (
+        "D=-D",
+    ),
+    "not": (
+        "D=!D",
+    )
+}
+
+SMALL_INDEX = 6  # Largest index a pop or store reaches with A=A+1 steps instead of going through R13/R14
+SMALL_LOAD_INDEX = 1  # Largest index a load reaches with A=A+1 steps in fewer instructions than "@index / A=D+A"
+COMPARISON_JUMPS = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}  # Jump taken when x - y makes the comparison true
+
+PUSH_D = (
+    "@SP",  # Load SP
+    "A=M",  # A = SP address
+    "M=D",  # Push D to stack
+    "@SP",
+    "M=M+1"  # SP++
+)
+
+# Templates per (command, segment). Placeholders: {index}, {base} (segment base register),
+# {address} (temp/pointer cell), {static} (File.index symbol), {complement} (~index),
+# {offset} (index + 1, distance of a stack cell below SP)
+LOAD_TEMPLATES = {
+    "constant": (
+        "@{index}",  # Load constant into A
+        "D=A"  # D = constant
+    ),
+    "negative constant": (  # Only produced by constant folding
+        "@{complement}",
+        "D=!A"  # D = !(-index - 1) = index
+    ),
+    "segment": (
+        "@{base}",  # Load base address
+        "D=M",  # D = base
+        "@{index}",  # Load index
+        "A=D+A",  # A = base + index
+        "D=M"  # D = RAM[base + index]
+    ),
+    "direct": (
+        "@{address}",  # Get direct address
+        "D=M"  # D = value at address
+    ),
+    "static": (
+        "@{static}",  # Load static variable
+        "D=M"  # D = value
+    ),
+    "stack": (  # Only produced by inlining
+        "@SP",
+        "D=M",
+        "@{offset}",
+        "A=D-A",  # A = SP - 1 - index
+        "D=M"
+    )
+}
+
+# Templates per (command, segment kind). Placeholders: {index}, {base} (segment base register),
+# {address} (temp/pointer cell), {static} (File.index symbol), {complement} (~index), {offset} (index + 1).
+# "load" and "store" move the value between the segment and D, for the top-of-stack cache;
+# "address" sets R13 to a segment cell's address, for a move to store through.
+PUSH_POP_TEMPLATES = {("push", kind): template + PUSH_D for kind, template in LOAD_TEMPLATES.items()}
+PUSH_POP_TEMPLATES.update({("load", kind): template for kind, template in LOAD_TEMPLATES.items()})
+PUSH_POP_TEMPLATES.update({
+    ("pop", "segment"): (
+        "@{base}",  # Load base
+        "D=M",  # D = base
+        "@{index}",  # Load index
+        "D=D+A",  # D = base + index
+        "@R13",  # Use R13 for temp storage
+        "M=D",  # R13 = base + index
+        "@SP",  # Load SP
+        "AM=M-1",  # SP--, A = SP
+        "D=M",  # D = popped value
+        "@R13",  # Load saved address
+        "A=M",  # A = base + index
+        "M=D"  # RAM[base + index] = D
+    ),
+    ("pop", "direct"): (
+        "@SP",  # Load SP
+        "AM=M-1",  # SP--, A = SP
+        "D=M",  # D = popped value
+        "@{address}",  # Load target address
+        "M=D"  # Store value at address
+    ),
+    ("pop", "static"): (
+        "@SP",  # Load SP
+        "AM=M-1",  # SP--, A = SP
+        "D=M",  # D = popped value
+        "@{static}",  # Load static variable
+        "M=D"  # Store value
+    ),
+    ("store", "segment"): (
+        "@R13",
+        "M=D",  # R13 = value
+        "@{base}",
+        "D=M",  # D = base
+        "@{index}",
+        "D=D+A",  # D = base + index
+        "@R14",
+        "M=D",  # R14 = base + index
+        "@R13",
+        "D=M",
+        "@R14",
+        "A=M",
+        "M=D"  # RAM[base + index] = value
+    ),
+    ("pop", "stack"): (
+        "@SP",
+        "D=M-1",
+        "@{offset}",
+        "D=D-A",
+        "@R13",
+        "M=D",  # R13 = SP - 1 - index, once the value is popped
+        "@SP",
+        "AM=M-1",
+        "D=M",  # D = popped value
+        "@R13",
+        "A=M",
+        "M=D"
+    ),
+    ("pop", "near stack"): (
+        "@SP",
+        "AM=M-1",
+        "D=M"  # D = popped value, A = SP, then one A=A-1 per cell below it
+    ),
+    ("store", "stack"): (
+        "@R13",
+        "M=D",  # R13 = value
+        "@SP",
+        "D=M",
+        "@{offset}",
+        "D=D-A",
+        "@R14",
+        "M=D",  # R14 = SP - 1 - index
+        "@R13",
+        "D=M",
+        "@R14",
+        "A=M",
+        "M=D"
+    ),
+    ("store", "near stack"): (
+        "@SP",
+        "A=M"  # A = SP, then one A=A-1 per cell below it
+    ),
+    ("store", "near segment"): (
+        "@{base}",
+        "A=M"  # A = base, then one A=A+1 per index
+    ),
+    ("pop", "near segment"): (
+        "@SP",
+        "AM=M-1",
+        "D=M",  # D = popped value
+        "@{base}",
+        "A=M"  # A = base, then one A=A+1 per index
+    ),
+    ("load", "near segment"): (
+        "@{base}",
+        "A=M"  # A = base, then one A=A+1 per index
+    ),
+    ("push", "near segment"): (
+        "@{base}",
+        "A=M"  # A = base, then one A=A+1 per index
+    ),
+    ("address", "segment"): (  # For a move, computed before loading the value
+        "@{base}",
+        "D=M",
+        "@{index}",
+        "D=D+A",
+        "@R13",
+        "M=D"  # R13 = base + index
+    ),
+    ("address", "stack"): (
+        "@SP",
+        "D=M",
+        "@{offset}",
+        "D=D-A",
+        "@R13",
+        "M=D"  # R13 = SP - 1 - index
+    ),
+    ("store", "direct"): (
+        "@{address}",
+        "M=D"  # Store value at address
+    ),
+    ("store", "static"): (
+        "@{static}",
+        "M=D"  # Store value
+    )
+})
+
+SEGMENT_BASES = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
+DIRECT_BASES = {"temp": 5, "pointer": 3}  # temp starts at R5, pointer at R3
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_push_pop(command, segment, index, filename, near=False):
+    """Renders the push/pop template of a segment for one index (filename is only used by static).
+
+    near also reaches small segment indexes with A=A+1 steps in pops and loads.
+    """
+    if segment == "constant":
+        kind = "negative constant" if index < 0 else "constant"
+    elif segment in SEGMENT_BASES and command == "store" and index <= SMALL_INDEX:
+        kind = "near segment"
+    elif near and segment in SEGMENT_BASES and index <= (SMALL_INDEX if command == "pop" else SMALL_LOAD_INDEX):
+        kind = "near segment"
+    elif segment == "stack" and command in ("pop", "store") and index < SMALL_INDEX:
+        kind = "near stack"
+    elif segment in SEGMENT_BASES:
+        kind = "segment"
+    elif segment in DIRECT_BASES:
+        kind = "direct"
+    else:
+        kind = segment
+    template = PUSH_POP_TEMPLATES.get((command, kind), ())
+    lines = tuple(line.format(index=index, base=SEGMENT_BASES.get(segment),
+                              address=DIRECT_BASES.get(segment, 0) + index,
+                              static=f"{filename}.{index}", complement=~index, offset=index + 1)
+                  for line in template)
+    if kind == "near segment" and command in ("pop", "store"):
+        lines += ("A=A+1",) * index + ("M=D",)  # RAM[base + index] = value
+    elif kind == "near segment":
+        lines += ("A=A+1",) * index + ("D=M",)  # D = RAM[base + index]
+        if command == "push":
+            lines += PUSH_D
+    elif kind == "near stack":
+        lines += ("A=A-1",) * (index + 1) + ("M=D",)  # RAM[SP - 1 - index] = value
+    return lines
+
+
 class CodeWriter:
-    def __init__(self, output_path):
-        self.output_path = output_path
-        self.output_file = open(self.output_path, 'w')
+    def __init__(self, output_path, shared_calls=False, optimizer=None, shared_compare=False, tos_cache=False,
+                 count_instructions=False, output_format="asm", prologue_loop=0, segment_cache=False,
+                 source_map=False):
+        self.output_path = output_path  # None keeps the assembly in memory (see fragment)
+        self.output_format = output_format
+        # Machine code formats assemble the lines as they are flushed instead of writing them out
+        self.assembler = HackAssembler() if output_path and output_format != "asm" else None
+        self.output_file = open(self.output_path, 'w') if self.output_path and not self.assembler else None
+        self.filename = None
         self.label_counter = 0  # For unique labels in comparison operations
         self.call_counter = 0 # For unique function calls
+        self.shared_calls = shared_calls  # Jump to shared $$CALL/$$RETURN routines instead of inlining them
+        self.shared_compare = shared_compare  # Jump to shared $$EQ/$$GT/$$LT routines instead of inlining them
+        self.tos_cache = tos_cache  # Keep the stack top in D between commands of a basic block
+        self.tos_in_d = False  # The stack top currently lives in D rather than in RAM
+        self.prologue_loop = prologue_loop  # Zero the locals in a loop from this many on (0: always unrolled)
+        # Reach small segment indexes with A=A+1 and reuse what the previous push/pop left in A, D and R13
+        self.segment_cache = segment_cache
+        # What the last push/pop left behind: "A" and "R13" -> (segment, index, filename) of the cell whose
+        # address they hold, "D" -> cell whose value it holds. Any other code forgets it (see write_lines).
+        self.known = {}
+        self.used_routines = []  # Shared routines referenced so far, emitted once on close
+        self.optimizer = optimizer  # Rewrites each file's assembly with optimize(lines), e.g. a PassManager
+        self.pending_lines = []  # Lines held back for the optimizer or the caller
+        self.buffer = []  # Lines waiting to be written to the output file
+        self.count_instructions = count_instructions  # Keep instructions up to date (for --stats)
+        self.instructions = 0  # Instructions emitted so far, before the optimizer
+        self.flush_seconds = 0.0  # Time spent writing to the output file
+        self.mark_sources = source_map  # Interleave source_map markers with the code (see mark_source)
+        self.source_map = SourceMap() if source_map and output_path else None  # Built from the markers on output
+
+    def setFileName(self, filename):
+        """Starts a new VM file; labels are numbered per file so each file translates on its own"""
+        if self.output_path:
+            self.flush()  # The optimizer works on one file at a time
+        self.filename = filename
+        self.known = {}  # Files are translated (and cached) on their own, so nothing carries over
+        self.label_counter = 0
+        self.call_counter = 0
 
     def write_lines(self, lines):
-        for line in lines:
-            self.output_file.write(line + '\n')
+        if self.known:
+            self.known = {}
+        if self.count_instructions:
+            self.instructions += sum(1 for line in lines if is_instruction(line))
+        if self.optimizer or not self.output_path:
+            self.pending_lines.extend(lines)
+            return
+        self.buffer.extend(lines)
+        if len(self.buffer) >= FLUSH_LINES:
+            self.write_buffer()
+
+    def write_buffer(self):
+        """Writes the buffered lines to the output file in one call (or assembles them)"""
+        if self.buffer:
+            start = perf_counter()
+            if self.source_map:
+                self.buffer = self.source_map.feed(self.buffer)
+            if self.assembler:
+                self.assembler.feed(self.buffer)
+            else:
+                self.output_file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+            self.flush_seconds += perf_counter() - start
+
+    def fragment(self):
+        """Returns (and clears) the lines held in memory, after the optimizer if any"""
+        self.spill()  # A fragment never ends with the stack top in D
+        lines = self.pending_lines
+        self.pending_lines = []
+        if self.optimizer:
+            lines = self.optimizer.optimize(lines)
+        return lines
+
+    def flush(self):
+        """Writes the lines held in memory to the output file"""
+        self.buffer.extend(self.fragment())
+        self.write_buffer()
+
+    def write_fragment(self, lines):
+        """Writes already translated lines straight to the output file"""
+        self.flush()
+        self.buffer.extend(lines)
+        self.write_buffer()
 
     def close(self):
-        self.output_file.close()
+        self.write_routines()
+        start = perf_counter()
+        if self.assembler:
+            words = self.assembler.finish()
+            if self.output_format == "packed":
+                write_packed(self.output_path, words)
+            else:
+                write_hack(self.output_path, words)
+        else:
+            self.output_file.close()
+        if self.source_map:
+            self.source_map.save(source_map_path(self.output_path))
+        self.flush_seconds += perf_counter() - start
+
+    def mark_source(self, source, line_number, function_name):
+        """Attributes the instructions written next to a VM line, for the source map"""
+        known = self.known  # A comment changes no register
+        self.write_lines([source_mark(source, line_number, function_name)])
+        self.known = known
+
+    def spill(self):
+        """Writes a stack top cached in D back to the stack"""
+        if self.tos_in_d:
+            self.tos_in_d = False
+            self.write_lines(PUSH_D)
+
+    def use_routine(self, name):
+        """Marks a shared routine as referenced so it is emitted once at the end of the program."""
+        if name not in self.used_routines:
+            self.used_routines.append(name)
+
+    def write_routines(self):
+        """Writes every shared routine referenced by the program, after all translated code."""
+        routines = {
+            "$$CALL": self.call_routine,
+            "$$RETURN": self.return_routine,
+            "$$EQ": lambda: self.compare_routine("eq"),
+            "$$GT": lambda: self.compare_routine("gt"),
+            "$$LT": lambda: self.compare_routine("lt")
+        }
+        lines = []
+        if self.used_routines:
+            lines += [
+                "\n// Halt, so running past the end of the program never enters a shared routine",
+                "($$HALT)",
+                "@$$HALT",
+                "0;JMP"
+            ]
+        if self.used_routines and self.mark_sources:
+            lines.insert(1, source_mark("$$HALT", 0, None))
+        for name in self.used_routines:
+            lines.append(f"\n// Shared routine: {name}")
+            if self.mark_sources:
+                lines.append(source_mark(name, 0, None))
+            lines += routines[name]()
+        self.write_fragment(lines)  # Routines are hand-tuned, so they skip the optimizer
 
     def writeArithmetic(self, command):
         """Writes assembly code for arithmetic-logical VM command"""
-        if command == "add":
-            # Pop two values and add them
-            self.write_lines([
-                "@SP",  # Get stack pointer
-                "AM=M-1",  # Decrement SP and get address
-                "D=M",  # D = y
-                "A=A-1",  # Point to x
-                "M=D+M"  # x + y
-            ])
+        scratch = self.known.get("R13")
+        self.write_arithmetic(command)
+        if scratch:
+            self.known = {"R13": scratch}  # No arithmetic code writes R13 or a segment base
 
-        elif command == "sub":
-            # Pop two values and subtract
-            self.write_lines([
-                "@SP",  # Get stack pointer
-                "AM=M-1",  # Decrement SP and get address
-                "D=M",  # D = y
-                "A=A-1",  # Point to x
-                "M=M-D"  # x - y
-            ])
+    def write_arithmetic(self, command):
+        if self.tos_in_d and not (command in ["eq", "gt", "lt"] and self.shared_compare):
+            self.write_cached_arithmetic(command)
+            return
+        self.spill()
 
-        elif command == "neg":
-            # Negate top value
+        if command in ARITHMETIC_TEMPLATES:
+            self.write_lines(ARITHMETIC_TEMPLATES[command])
+
+        elif command in ["eq", "gt", "lt"] and self.shared_compare:
+            # Jump to the shared comparison routine with the return address in R15
+            return_label = f"{self.filename}.{command}_ret_{self.label_counter}"
+            self.label_counter += 1
+            routine = f"$${command.upper()}"
+            self.use_routine(routine)
             self.write_lines([
-                "@SP",  # Get stack pointer
-                "A=M-1",  # Point to top of stack
-                "M=-M"  # Negate value
+                f"@{return_label}",
+                "D=A",
+                "@R15",  # R15 = return address
+                "M=D",
+                f"@{routine}",
+                "0;JMP",
+                f"({return_label})"
             ])
 
         elif command in ["eq", "gt", "lt"]:
             # Compare top two values
-            label_true = f"{command}_true_{self.label_counter}"
-            label_end = f"{command}_end_{self.label_counter}"
+            label_true = f"{self.filename}.{command}_true_{self.label_counter}"
+            label_end = f"{self.filename}.{command}_end_{self.label_counter}"
             self.label_counter += 1
 
-            comparison = {
-                "eq": "JEQ",
-                "gt": "JGT",
-                "lt": "JLT"
-            }[command]
+            comparison = COMPARISON_JUMPS[command]
 
             self.write_lines([
                 "@SP",  # Get stack pointer
@@ -74,155 +505,218 @@ class CodeWriter:
                 f"({label_end})"
             ])
 
-        elif command == "and":
-            self.write_lines([
-                "@SP",  # Get stack pointer
-                "AM=M-1",  # Decrement SP and get address
-                "D=M",  # D = y
-                "A=A-1",  # Point to x
-                "M=D&M"  # x AND y
-            ])
+    def write_cached_arithmetic(self, command):
+        """Writes an arithmetic command whose y operand is cached in D, leaving the result in D"""
+        if command in CACHED_ARITHMETIC_TEMPLATES:
+            self.write_lines(CACHED_ARITHMETIC_TEMPLATES[command])
+            return
+
+        label_true = f"{self.filename}.{command}_true_{self.label_counter}"
+        label_end = f"{self.filename}.{command}_end_{self.label_counter}"
+        self.label_counter += 1
+        comparison = COMPARISON_JUMPS[command]
+        self.write_lines([
+            "@SP",
+            "AM=M-1",  # Pop x
+            "D=M-D",  # D = x - y
+            f"@{label_true}",
+            f"D;{comparison}",  # Jump if comparison true
+            "D=0",  # False
+            f"@{label_end}",
+            "0;JMP",
+            f"({label_true})",
+            "D=-1",  # True
+            f"({label_end})"
+        ])
 
-        elif command == "or":
+    def writePushPop(self, command, segment, index, scope=None):
+        """Writes assembly code for push/pop VM command (scope: file owning a static cell, if not this one)"""
+        # Only static cells depend on the file, so other segments share cache entries across files
+        filename = (scope or self.filename) if segment == "static" else None
+        if self.segment_cache and segment != "stack":  # Stack cells move with SP, so they are never reused
+            self.write_cached_push_pop(command, (segment, index, filename))
+            return
+        if self.tos_cache and command == "push":
+            # The pushed value stays in D until a command needs the stack in RAM
+            self.spill()
+            self.write_lines(render_push_pop("load", segment, index, filename))
+            self.tos_in_d = True
+            return
+        if self.tos_in_d and command == "pop":
+            self.write_lines(render_push_pop("store", segment, index, filename))
+            self.tos_in_d = False
+            return
+        self.write_lines(render_push_pop(command, segment, index, filename))
+
+    def write_cached_push_pop(self, command, cell):
+        """writePushPop for segment_cache: uses the fewest instructions given what A, D and R13 hold"""
+        segment, index, filename = cell
+        known = self.known  # Read first, since writing anything forgets it
+        if command == "push":
+            if self.tos_in_d:
+                self.spill()
+                known = {name: held for name, held in known.items() if name != "A"}  # A = SP after the spill
+            lines = self.cached_load(cell, known)
+            self.write_lines(lines if self.tos_cache else lines + PUSH_D)
+            self.tos_in_d = self.tos_cache
+        else:
+            candidates = [render_push_pop("store" if self.tos_in_d else "pop", segment, index, filename, True)]
+            if known.get("R13") == cell:
+                candidates.append((() if self.tos_in_d else ("@SP", "AM=M-1", "D=M")) + ("@R13", "A=M", "M=D"))
+            relative = self.relative_address(cell, known.get("A"))
+            if relative is not None and self.tos_in_d:
+                candidates.append(relative + ("M=D",))
+            lines = min(candidates, key=len)
+            self.write_lines(lines)
+            self.tos_in_d = False
+
+        self.known = {"D": cell}
+        # A points at the cell after a pop or a load, at the stack after a push, and is unchanged by no lines
+        if command == "pop":
+            address = cell
+        elif self.tos_cache:
+            address = cell if lines else known.get("A")
+        else:
+            address = None
+        if address and address[0] in SEGMENT_BASES:
+            self.known["A"] = address
+        scratch = known.get("R13")
+        if "@R14" in lines:
+            scratch = None  # The store template keeps the value in R13
+        elif "@R13" in lines:
+            scratch = cell  # Computed by the pop template, or reused
+        if command == "pop" and segment == "pointer" and scratch and scratch[0] == ("this", "that")[index]:
+            scratch = None  # Its base just changed
+        if scratch:
+            self.known["R13"] = scratch
+
+    def cached_load(self, cell, known):
+        """Returns the fewest lines that set D to the value of a cell, given what A, D and R13 hold"""
+        segment, index, filename = cell
+        candidates = [render_push_pop("load", segment, index, filename, True)]
+        if known.get("D") == cell:
+            candidates.append(())
+        if known.get("R13") == cell:
+            candidates.append(("@R13", "A=M", "D=M"))
+        relative = self.relative_address(cell, known.get("A"))
+        if relative is not None:
+            candidates.append(relative + ("D=M",))
+        return min(candidates, key=len)
+
+    @staticmethod
+    def relative_address(cell, held):
+        """Returns the A=A+1 or A=A-1 steps from the address of the cell held in A to the cell, or None"""
+        if held is None or held[0] != cell[0] or cell[0] not in SEGMENT_BASES:
+            return None
+        step = cell[1] - held[1]
+        return ("A=A+1",) * step if step >= 0 else ("A=A-1",) * -step
+
+    def writeMove(self, segment, index, target_segment, target_index, scope=None):
+        """Writes assembly code for a fused push/pop that copies one cell without touching the stack"""
+        source_file = (scope or self.filename) if segment == "static" else None
+        target_file = (scope or self.filename) if target_segment == "static" else None
+        if self.segment_cache and target_segment in SEGMENT_BASES and target_index <= SMALL_INDEX:
+            self.write_near_move((segment, index, source_file), (target_segment, target_index, None))
+            return
+
+        self.spill()
+        load = render_push_pop("load", segment, index, source_file)
+        store = render_push_pop("store", target_segment, target_index, target_file)
+        address = render_push_pop("address", target_segment, target_index, None)
+        if address and len(address) + 3 < len(store):
+            store = ("@R13", "A=M", "M=D")  # RAM[target address] = D
+        else:
+            address = ()
+        self.write_lines((f"// move {segment} {index} {target_segment} {target_index}",) + address + load + store)
+
+    def write_near_move(self, source, target):
+        """writeMove for segment_cache, to a segment cell reached with A=A+1 steps instead of through R13"""
+        known = self.known
+        if self.tos_in_d:
+            self.spill()
+            known = {name: held for name, held in known.items() if name != "A"}
+        if source[0] == "stack":
+            load = render_push_pop("load", "stack", source[1], None)
+        else:
+            load = self.cached_load(source, known)
+        held = source if load and source[0] in SEGMENT_BASES else known.get("A") if not load else None
+        relative = self.relative_address(target, held)
+        store = render_push_pop("store", target[0], target[1], None)
+        if relative is not None and len(relative) + 1 < len(store):
+            store = relative + ("M=D",)
+        self.write_lines((f"// move {' '.join(map(str, source[:2]))} {' '.join(map(str, target[:2]))}",)
+                         + load + store)
+        self.known = {"A": target, "D": target}
+        if known.get("R13"):
+            self.known["R13"] = known["R13"]
+
+    def writeDrop(self, count):
+        """Writes assembly code that discards the top count values of the stack"""
+        if self.tos_in_d and count:
+            self.tos_in_d = False
+            count -= 1
+        if count == 1:
             self.write_lines([
-                "@SP",  # Get stack pointer
-                "AM=M-1",  # Decrement SP and get address
-                "D=M",  # D = y
-                "A=A-1",  # Point to x
-                "M=D|M"  # x OR y
+                "@SP",
+                "M=M-1"  # SP--
             ])
-
-        elif command == "not":
+        elif count > 1:
             self.write_lines([
-                "@SP",  # Get stack pointer
-                "A=M-1",  # Point to top of stack
-                "M=!M"  # NOT x
+                f"@{count}",
+                "D=A",
+                "@SP",
+                "M=M-D"  # SP -= count
             ])
 
-    def writePushPop(self, command, segment, index):
-        """Writes assembly code for push/pop VM command"""
-        # Dictionary mapping segments to their base registers
-        segment_table = {
-            "local": "LCL",
-            "argument": "ARG",
-            "this": "THIS",
-            "that": "THAT",
-            "temp": "5",  # temp starts at R5
-            "pointer": "3"  # pointer starts at R3
-        }
+    def writeLabel(self, label, function_name=None):
+        """Writes a VM label, scoped to the function it appears in"""
+        self.spill()
+        self.write_lines([f"({scoped_label(label, function_name)})"])
 
-        if command == "push":  # Handle push command
-            if segment == "constant":
-                # Push constant value
-                self.write_lines([
-                    f"@{index}",  # Load constant into A
-                    "D=A",  # D = constant
-                    "@SP",  # Get stack pointer
-                    "A=M",  # Go to address of stack pointer
-                    "M=D",  # Write D to top of stack
-                    "@SP",  # Get stack pointer again
-                    "M=M+1"  # Increment SP
-                ])
-
-            elif segment in ["local", "argument", "this", "that"]:
-                # Push from segment[index]
-                self.write_lines([
-                    f"@{segment_table[segment]}",  # Load base address
-                    "D=M",  # D = base
-                    f"@{index}",  # Load index
-                    "A=D+A",  # A = base + index
-                    "D=M",  # D = RAM[base + index]
-                    "@SP",  # Load SP
-                    "A=M",  # A = SP address
-                    "M=D",  # Push D to stack
-                    "@SP",
-                    "M=M+1"  # SP++
-                ])
-
-            elif segment == "temp" or segment == "pointer":
-                # Push from temp/pointer (direct addressing)
-                base = int(segment_table[segment])
-                self.write_lines([
-                    f"@{base + index}",  # Get direct address
-                    "D=M",  # D = value at address
-                    "@SP",  # Load SP
-                    "A=M",  # A = SP address
-                    "M=D",  # Push to stack
-                    "@SP",
-                    "M=M+1"  # SP++
-                ])
-
-            elif segment == "static":
-                # Push from static variable
-                self.write_lines([
-                    f"@{self.filename}.{index}",  # Load static variable
-                    "D=M",  # D = value
-                    "@SP",  # Load SP
-                    "A=M",  # A = SP address
-                    "M=D",  # Push to stack
-                    "@SP",
-                    "M=M+1"  # SP++
-                ])
-
-        elif command == "pop":  # Handle pop command
-            if segment in ["local", "argument", "this", "that"]:
-                # Pop to segment[index]
-                self.write_lines([
-                    f"@{segment_table[segment]}",  # Load base
-                    "D=M",  # D = base
-                    f"@{index}",  # Load index
-                    "D=D+A",  # D = base + index
-                    "@R13",  # Use R13 for temp storage
-                    "M=D",  # R13 = base + index
-                    "@SP",  # Load SP
-                    "AM=M-1",  # SP--, A = SP
-                    "D=M",  # D = popped value
-                    "@R13",  # Load saved address
-                    "A=M",  # A = base + index
-                    "M=D"  # RAM[base + index] = D
-                ])
-
-            elif segment == "temp" or segment == "pointer":
-                # Pop to temp/pointer (direct addressing)
-                base = int(segment_table[segment])
-                self.write_lines([
-                    "@SP",  # Load SP
-                    "AM=M-1",  # SP--, A = SP
-                    "D=M",  # D = popped value
-                    f"@{base + index}",  # Load target address
-                    "M=D"  # Store value at address
-                ])
-
-            elif segment == "static":
-                # Pop to static variable
-                self.write_lines([
-                    "@SP",  # Load SP
-                    "AM=M-1",  # SP--, A = SP
-                    "D=M",  # D = popped value
-                    f"@{self.filename}.{index}",  # Load static variable
-                    "M=D"  # Store value
-                ])
-
-    def writeLabel(self, label):
-        self.write_lines([f"({label})"])
-
-    def writeGoto(self, label):
+    def writeGoto(self, label, function_name=None):
+        self.spill()
         self.write_lines([
-            f"@{label}",
+            f"@{scoped_label(label, function_name)}",
             "0;JMP"
         ])
 
-    def writeIf(self, label):
+    def writeIf(self, label, when_false=False, function_name=None):
+        """Writes a conditional jump on the popped value; when_false jumps if it is false (if-not-goto)"""
+        jump = "D;JEQ" if when_false else "D;JNE"
+        label = scoped_label(label, function_name)
+        if self.tos_in_d:
+            self.tos_in_d = False
+            self.write_lines([
+                f"@{label}",
+                jump  # Jump on the cached top
+            ])
+            return
+
         self.write_lines([
             "@SP",  # A = stack pointer address
             "AM=M-1",  # M[SP] = M[SP]-1, A = M[SP]
             "D=M",  # D = value at top of stack
             "@" + label,  # Load jump destination
-            "D;JNE",  # Jump if D ≠ 0 (value is true)
+            jump,  # Jump if D ≠ 0 (value is true), or D = 0 when_false
         ])
 
-    def writeFunction(self, functionName, nVars):
+    def write_counter(self, name, counter):
+        """Increments a profiling counter (a RAM address after the statics), leaving D untouched"""
+        self.write_lines([
+            f"// profile {name}",
+            f"@{counter}",
+            "M=M+1"
+        ])
+
+    def writeFunction(self, functionName, nVars, counter=None):
+        self.spill()
         self.write_lines([f"({functionName})"])
+        if counter is not None:
+            self.write_counter(functionName, counter)
+
+        if self.prologue_loop and nVars >= self.prologue_loop:
+            self.write_zero_loop(functionName, nVars)
+            return
 
         for i in range(nVars):
             self.write_lines([
@@ -233,10 +727,33 @@ class CodeWriter:
                 "M=M+1"  # SP++ (increment stack pointer)
             ])
 
-    def writeCall(self, functionName, nArgs):
-        return_address = f"{functionName}$ret.{self.call_counter}"
+    def write_zero_loop(self, functionName, nVars):
+        """Pushes nVars zeros in a loop: 9 instructions whatever nVars, but 7 cycles per local instead of 5"""
+        loop = f"{functionName}$$zero"  # "$$" cannot clash with a VM label, which has no "$"
+        self.write_lines([
+            f"@{nVars}",
+            "D=A",  # D = locals left to push
+            f"({loop})",
+            "@SP",
+            "AM=M+1",  # SP++
+            "A=A-1",
+            "M=0",  # M[SP-1] = 0
+            "D=D-1",
+            f"@{loop}",
+            "D;JGT"
+        ])
+
+    def writeCall(self, functionName, nArgs, counter=None):
+        self.spill()
+        if counter is not None:
+            self.write_counter(f"call {functionName}", counter)
+        return_address = f"{functionName}$ret.{self.filename}.{self.call_counter}"
         self.call_counter += 1
 
+        if self.shared_calls:
+            self.write_shared_call(functionName, nArgs, return_address)
+            return
+
         # Save return address
         self.write_lines([
             "// Save return address",
@@ -295,7 +812,223 @@ class CodeWriter:
         self.write_lines([
             f"({return_address})"
         ])
+
+    def writeTailCall(self, functionName, nArgs, counter=None):
+        """Writes a call directly followed by return, which hands the current frame over to the callee.
+
+        The callee returns straight to our caller, so it takes over our ARG
+        and saved frame: the arguments are moved down to ARG and the callee
+        starts at our LCL. If the arguments would overwrite the saved frame,
+        the frame is first pushed above them and both are moved down together.
+        """
+        self.spill()
+        if counter is not None:
+            self.write_counter(f"call {functionName}", counter)
+        staged = f"{functionName}$tail.{self.filename}.{self.call_counter}"
+        self.call_counter += 1
+
+        lines = [
+            f"// tail call {functionName} {nArgs}",
+            "@LCL",
+            "D=M",
+            f"@{nArgs + 5}",
+            "D=D-A",
+            "@ARG",
+            "D=D-M",  # D = cells between ARG + nArgs and the saved frame
+            f"@{staged}",
+            "D;JLT"
+        ]
+        lines += self.copy_down(nArgs)
+        lines += [
+            "@LCL",
+            "D=M",
+            "@SP",
+            "M=D",  # SP = LCL, the callee's frame is ours
+            f"@{functionName}",
+            "0;JMP",
+            f"({staged})",
+            "@LCL",
+            "D=M",
+            "@6",
+            "D=D-A",
+            "@R13",
+            "M=D"  # R13 = frame - 6, one cell before the saved return address
+        ]
+        for _ in range(5):
+            lines += [
+                "@R13",
+                "AM=M+1",
+                "D=M",  # Next saved cell
+                "@SP",
+                "M=M+1",
+                "A=M-1",
+                "M=D"  # Push it
+            ]
+        lines += self.copy_down(nArgs + 5)
+        lines += [
+            "@R14",
+            "D=M+1",
+            "@LCL",
+            "M=D",  # LCL = ARG + nArgs + 5
+            "@SP",
+            "M=D",  # SP = LCL
+            f"@{functionName}",
+            "0;JMP"
+        ]
+        self.write_lines(lines)
+
+    def copy_down(self, count):
+        """Returns instructions that copy the top count stack cells to ARG onwards, leaving R14 at the last one"""
+        if not count:
+            return []
+        lines = [
+            "@SP",
+            "D=M",
+            f"@{count + 1}",
+            "D=D-A",
+            "@R13",
+            "M=D",  # R13 = one cell before the first copied cell
+            "@ARG",
+            "D=M-1",
+            "@R14",
+            "M=D"  # R14 = ARG - 1
+        ]
+        for _ in range(count):
+            lines += [
+                "@R13",
+                "AM=M+1",
+                "D=M",
+                "@R14",
+                "AM=M+1",
+                "M=D"  # Copy the next cell down
+            ]
+        return lines
+
+    def write_shared_call(self, functionName, nArgs, return_address):
+        """Loads callee, nArgs and return address into R13/R14/D and jumps to the shared $$CALL routine"""
+        self.use_routine("$$CALL")
+        self.write_lines([
+            f"// call {functionName} {nArgs}",
+            f"@{functionName}",
+            "D=A",
+            "@R13",  # R13 = callee address
+            "M=D",
+            f"@{nArgs}",
+            "D=A",
+            "@R14",  # R14 = nArgs
+            "M=D",
+            f"@{return_address}",
+            "D=A",  # D = return address
+            "@$$CALL",
+            "0;JMP",
+            f"({return_address})"
+        ])
+
+    def call_routine(self):
+        """Frame-save sequence shared by every call site (callee in R13, nArgs in R14, return address in D)"""
+        lines = [
+            "($$CALL)",
+            "@SP",
+            "A=M",
+            "M=D"  # Push return address
+        ]
+        for segment in ["LCL", "ARG", "THIS", "THAT"]:
+            lines += [
+                f"@{segment}",  # Push the caller's segment
+                "D=M",
+                "@SP",
+                "AM=M+1",
+                "M=D"
+            ]
+        lines += [
+            "@SP",
+            "MD=M+1",  # SP past the saved frame, D = SP
+            "@LCL",
+            "M=D",  # LCL = SP
+            "@R14",
+            "D=D-M",
+            "@5",
+            "D=D-A",
+            "@ARG",
+            "M=D",  # ARG = SP - nArgs - 5
+            "@R13",
+            "A=M",
+            "0;JMP"  # goto callee
+        ]
+        return lines
+
+    def return_routine(self):
+        """Frame-restore sequence shared by every function's return"""
+        lines = [
+            "($$RETURN)",
+            "@LCL",
+            "D=M",
+            "@R13",
+            "M=D",  # R13 = frame
+            "@5",
+            "A=D-A",
+            "D=M",
+            "@R14",
+            "M=D",  # R14 = return address
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            "@ARG",
+            "A=M",
+            "M=D",  # *ARG = return value
+            "D=A+1",
+            "@SP",
+            "M=D"  # SP = ARG + 1
+        ]
+        for segment in ["THAT", "THIS", "ARG", "LCL"]:
+            lines += [
+                "@R13",
+                "AM=M-1",  # frame--
+                "D=M",
+                f"@{segment}",
+                "M=D"  # Restore the caller's segment
+            ]
+        lines += [
+            "@R14",
+            "A=M",
+            "0;JMP"  # Jump to return address
+        ]
+        return lines
+
+    def compare_routine(self, command):
+        """Comparison shared by every eq/gt/lt site of one kind (return address in R15)"""
+        routine = f"$${command.upper()}"
+        comparison = COMPARISON_JUMPS[command]
+        return [
+            f"({routine})",
+            "@SP",
+            "AM=M-1",  # Decrement SP and get address
+            "D=M",  # D = y
+            "A=A-1",  # Point to x
+            "D=M-D",  # D = x - y
+            "M=-1",  # Assume true (-1)
+            f"@{routine}_RETURN",
+            f"D;{comparison}",  # Keep true if comparison holds
+            "@SP",
+            "A=M-1",
+            "M=0",  # Otherwise false (0)
+            f"({routine}_RETURN)",
+            "@R15",
+            "A=M",
+            "0;JMP"  # Jump to return address
+        ]
+
     def writeReturn(self):
+        self.spill()
+        if self.shared_calls:
+            self.use_routine("$$RETURN")
+            self.write_lines([
+                "// return",
+                "@$$RETURN",
+                "0;JMP"
+            ])
+            return
+
         self.write_lines([
             f"//Store our frame (LCL) in R13 temporally",
             "@LCL",
@@ -0,0 +1,174 @@
+from vm_ir import Command, Opcode
+
+CONDITIONAL_OPS = frozenset([Opcode.IF_GOTO, Opcode.IF_NOT_GOTO])
+JUMP_OPS = CONDITIONAL_OPS | {Opcode.GOTO}
+TERMINATORS = frozenset([Opcode.GOTO, Opcode.RETURN, Opcode.TAIL_CALL])  # Never fall through to the next command
+INVERTED = {Opcode.IF_GOTO: Opcode.IF_NOT_GOTO, Opcode.IF_NOT_GOTO: Opcode.IF_GOTO}
+
+
+def split_at_functions(commands):
+    """Yields the commands of each function as a list; top-level code before the first function comes first"""
+    function = []
+    for command in commands:
+        if command.op == Opcode.FUNCTION and function:
+            yield function
+            function = []
+        function.append(command)
+    if function:
+        yield function
+
+
+def labels_at(commands, index):
+    """Returns the labels of the run of label commands starting at index"""
+    labels = []
+    while index < len(commands) and commands[index].op == Opcode.LABEL:
+        labels.append(commands[index].name)
+        index += 1
+    return labels
+
+
+class ControlFlowOptimizer:
+    """Simplifies the branches of a file's Commands, one function at a time.
+
+    Jumps to a label followed by a goto go straight to the goto's target,
+    "if-goto L1 / goto L2 / label L1" becomes "if-not-goto L2 / label L1",
+    jumps to the very next command disappear, and commands control cannot
+    reach and labels no jump refers to are dropped. Labels are taken to be
+    local to their function, as the VM language defines them; a function
+    jumping to a label it does not define keeps its blocks and labels.
+    """
+
+    def __init__(self):
+        # Jumps retargeted, branches inverted, and commands removed by each rewrite, then the jumps removed in all
+        self.applied = {"threaded": 0, "inverted": 0, "jump to next": 0, "unreachable": 0, "unused label": 0,
+                        "jumps removed": 0}
+
+    def optimize(self, commands):
+        """Returns an iterator over the rewritten commands"""
+        for function in split_at_functions(commands):
+            yield from self.optimize_function(function)
+
+    def optimize_function(self, commands):
+        """Rewrites one function's commands until none of the rewrites applies"""
+        rewrites = [self.thread_jumps, self.invert_branches, self.drop_jumps_to_next, self.drop_unreachable]
+        changed = True
+        while changed:
+            changed = False
+            for rewrite in rewrites:
+                commands, applied = rewrite(commands)
+                changed = changed or applied
+        return commands
+
+    @staticmethod
+    def label_positions(commands):
+        return {command.name: i for i, command in enumerate(commands) if command.op == Opcode.LABEL}
+
+    def thread_jumps(self, commands):
+        """Retargets jumps to the first label of their label run, and past the gotos those labels lead to"""
+        positions = self.label_positions(commands)
+
+        def first_label(label):
+            index = positions[label]
+            while index > 0 and commands[index - 1].op == Opcode.LABEL:
+                index -= 1
+            return commands[index].name
+
+        def final_target(label):
+            label = first_label(label)
+            seen = set()
+            while label not in seen:
+                seen.add(label)
+                after = positions[label] + len(labels_at(commands, positions[label]))
+                if after < len(commands) and commands[after].op == Opcode.GOTO and commands[after].name in positions:
+                    label = first_label(commands[after].name)
+                else:
+                    break
+            return label
+
+        threaded = 0
+        result = []
+        for command in commands:
+            if command.op in JUMP_OPS and command.name in positions:
+                target = final_target(command.name)
+                if target != command.name:
+                    if target != first_label(command.name):
+                        threaded += 1  # Skips a goto, rather than naming the same spot differently
+                    command = Command(command.op, name=target, line_number=command.line_number)
+            result.append(command)
+        self.applied["threaded"] += threaded
+        return result, result != commands
+
+    def invert_branches(self, commands):
+        """Turns "if-goto L1 / goto L2 / label L1" into "if-not-goto L2 / label L1" """
+        result = []
+        inverted = 0
+        i = 0
+        while i < len(commands):
+            command = commands[i]
+            if (command.op in CONDITIONAL_OPS and i + 1 < len(commands) and commands[i + 1].op == Opcode.GOTO
+                    and command.name in labels_at(commands, i + 2)):
+                result.append(Command(INVERTED[command.op], name=commands[i + 1].name,
+                                      line_number=command.line_number))
+                inverted += 1
+                self.applied["jumps removed"] += 1
+                i += 2
+                continue
+            result.append(command)
+            i += 1
+        self.applied["inverted"] += inverted
+        return result, inverted
+
+    def drop_jumps_to_next(self, commands):
+        """Removes gotos to the labels right after them; conditional ones only pop their condition"""
+        result = []
+        dropped = 0
+        for i, command in enumerate(commands):
+            if command.op in JUMP_OPS and command.name in labels_at(commands, i + 1):
+                dropped += 1
+                if command.op in CONDITIONAL_OPS:
+                    result.append(Command(Opcode.DROP, index=1, line_number=command.line_number))
+                continue
+            result.append(command)
+        self.applied["jump to next"] += dropped
+        self.applied["jumps removed"] += dropped
+        return result, dropped
+
+    def drop_unreachable(self, commands):
+        """Removes the commands no path from the function's entry reaches, then the labels no jump uses"""
+        positions = self.label_positions(commands)
+        if any(c.op in JUMP_OPS and c.name not in positions for c in commands):
+            return commands, 0  # Jumps leave the function: its labels may be used from outside
+        reachable = set()
+        pending = [0] if commands else []
+        while pending:
+            i = pending.pop()
+            while i < len(commands) and i not in reachable:
+                reachable.add(i)
+                command = commands[i]
+                if command.op in JUMP_OPS:
+                    pending.append(positions[command.name])
+                if command.op in TERMINATORS:
+                    break
+                i += 1
+        used = {commands[i].name for i in reachable if commands[i].op in JUMP_OPS}
+
+        result = []
+        unreachable = unused = 0
+        for i, command in enumerate(commands):
+            if command.op == Opcode.LABEL:
+                if command.name not in used:
+                    unused += 1
+                    continue
+            elif i not in reachable:
+                unreachable += 1
+                if command.op in JUMP_OPS:
+                    self.applied["jumps removed"] += 1
+                continue
+            result.append(command)
+        self.applied["unreachable"] += unreachable
+        self.applied["unused label"] += unused
+        return result, unreachable + unused
+
+    def report(self):
+        """Returns one line per rewrite with its count, then the number of jumps removed"""
+        return "\n".join(f"{name:<16}{count:>8}" for name, count in self.applied.items())
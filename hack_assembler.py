@@ -0,0 +1,158 @@
+import os
+import sys
+from array import array
+
+# Computation field (a-bit + c1..c6) of every comp mnemonic
+COMP_CODES = {
+    "0": 0b0101010, "1": 0b0111111, "-1": 0b0111010,
+    "D": 0b0001100, "A": 0b0110000, "M": 0b1110000,
+    "!D": 0b0001101, "!A": 0b0110001, "!M": 0b1110001,
+    "-D": 0b0001111, "-A": 0b0110011, "-M": 0b1110011,
+    "D+1": 0b0011111, "A+1": 0b0110111, "M+1": 0b1110111,
+    "D-1": 0b0001110, "A-1": 0b0110010, "M-1": 0b1110010,
+    "D+A": 0b0000010, "D+M": 0b1000010,
+    "D-A": 0b0010011, "D-M": 0b1010011,
+    "A-D": 0b0000111, "M-D": 0b1000111,
+    "D&A": 0b0000000, "D&M": 0b1000000,
+    "D|A": 0b0010101, "D|M": 0b1010101
+}
+DEST_BITS = {"A": 0b100, "D": 0b010, "M": 0b001}
+JUMP_CODES = {"": 0, "JGT": 1, "JEQ": 2, "JGE": 3, "JLT": 4, "JNE": 5, "JLE": 6, "JMP": 7}
+
+PREDEFINED_SYMBOLS = {"SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4, "SCREEN": 16384, "KBD": 24576}
+PREDEFINED_SYMBOLS.update({f"R{i}": i for i in range(16)})
+FIRST_VARIABLE_ADDRESS = 16
+
+PACKED_EXTENSION = ".bin"  # Packed programs: one little-endian 16-bit word per instruction
+# File extension of each program format: assembly, .hack text, or packed machine words
+OUTPUT_FORMATS = {"asm": ".asm", "hack": ".hack", "packed": PACKED_EXTENSION}
+
+
+class HackAssembler:
+    """Two-pass assembler from Hack assembly lines to 16-bit machine words.
+
+    Lines can be fed in chunks as they are generated: the first pass binds
+    labels and encodes everything but symbolic A-instructions on the fly,
+    and finish resolves those in program order, allocating variables the
+    way a whole-file assembler does.
+    """
+
+    def __init__(self):
+        self.symbols = dict(PREDEFINED_SYMBOLS)
+        self.next_variable = FIRST_VARIABLE_ADDRESS
+        self.words = array("H")
+        self.fixups = []  # (ROM address, symbol, line number) of every A-instruction naming a symbol
+        self.line_number = 0
+        self.decoded = {}  # Line text -> decode result, for every line but labels
+
+    def assemble(self, lines):
+        """Returns the machine words of a program given as assembly lines"""
+        self.feed(lines)
+        return list(self.finish())
+
+    def feed(self, lines):
+        """First pass over the next lines of the program: binds labels and encodes all but symbols"""
+        words, fixups, decoded = self.words, self.fixups, self.decoded
+        line_number = self.line_number
+        for line_number, line in enumerate(lines, line_number + 1):
+            code = decoded.get(line)
+            if code is None:
+                code = self.decode(line, line_number)
+                if type(code) is tuple:
+                    self.bind_label(code[0], len(words), line_number)
+                    continue
+                decoded[line] = code
+            if type(code) is int:
+                words.append(code)
+            elif code:
+                fixups.append((len(words), code, line_number))
+                words.append(0)
+        self.line_number = line_number
+
+    def bind_label(self, label, address, line_number):
+        if label in self.symbols and label not in PREDEFINED_SYMBOLS:
+            raise ValueError(f"line {line_number}: label '{label}' is defined twice")
+        self.symbols[label] = address
+
+    @classmethod
+    def decode(cls, line, line_number=0):
+        """Returns a line's machine word, the symbol of a symbolic A-instruction, (label,) or "" for no instruction"""
+        instruction = line.split("//")[0].strip()
+        if not instruction:
+            return ""
+        if instruction.startswith("("):
+            return (instruction[1:-1],)
+        if instruction.startswith("@"):
+            symbol = instruction[1:]
+            if not symbol.isdigit():
+                return symbol
+            value = int(symbol)
+            if value > 0x7FFF:
+                raise ValueError(f"line {line_number}: constant {value} does not fit in 15 bits")
+            return value
+        return cls.encode(instruction, line_number)
+
+    def finish(self):
+        """Second pass: resolves the symbolic A-instructions, returns the program as an array('H')"""
+        for address, symbol, _ in self.fixups:
+            if symbol not in self.symbols:
+                self.symbols[symbol] = self.next_variable
+                self.next_variable += 1
+            self.words[address] = self.symbols[symbol]
+        self.fixups = []
+        return self.words
+
+    @staticmethod
+    def encode(instruction, line_number=0):
+        """Encodes one C-instruction"""
+        dest, comp, jump = "", instruction, ""
+        if "=" in comp:
+            dest, comp = comp.split("=", 1)
+        if ";" in comp:
+            comp, jump = comp.split(";", 1)
+        if comp not in COMP_CODES or jump not in JUMP_CODES or any(d not in DEST_BITS for d in dest):
+            raise ValueError(f"line {line_number}: invalid instruction '{instruction}'")
+        dest_bits = 0
+        for register in dest:
+            dest_bits |= DEST_BITS[register]
+        return 0b111 << 13 | COMP_CODES[comp] << 6 | dest_bits << 3 | JUMP_CODES[jump]
+
+
+def assemble_file(path):
+    """Assembles a .asm file into a list of machine words"""
+    with open(path) as source:
+        return HackAssembler().assemble(source)
+
+
+def write_hack(path, words):
+    """Writes machine words as a .hack file, one 16-digit binary line per word"""
+    text = {}  # word -> its line; programs reuse few distinct words
+    for word in set(words):
+        text[word] = f"{word:016b}\n"
+    with open(path, 'w') as output:
+        output.write("".join(map(text.__getitem__, words)))
+
+
+def write_packed(path, words):
+    """Writes machine words as a packed little-endian array of 16-bit words"""
+    words = array("H", words)
+    if sys.byteorder == "big":
+        words.byteswap()
+    with open(path, 'wb') as output:
+        words.tofile(output)
+
+
+def load_program(path):
+    """Returns the machine words of a .asm, .hack or packed program file"""
+    extension = os.path.splitext(path)[1]
+    if extension == ".hack":
+        with open(path) as program:
+            return [int(line, 2) for line in program if line.strip()]
+    if extension == PACKED_EXTENSION:
+        words = array("H")
+        with open(path, 'rb') as program:
+            words.frombytes(program.read())
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words
+    return assemble_file(path)
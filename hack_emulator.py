@@ -0,0 +1,262 @@
+import argparse
+import os
+import re
+import sys
+from array import array
+from hack_assembler import OUTPUT_FORMATS, load_program
+
+RAM_SIZE = 32768  # 15-bit data addresses
+WORD = 0xFFFF
+
+# ALU of every computation field, on unsigned 16-bit values
+COMPUTATIONS = {
+    0b0101010: lambda a, d, m: 0,
+    0b0111111: lambda a, d, m: 1,
+    0b0111010: lambda a, d, m: WORD,
+    0b0001100: lambda a, d, m: d,
+    0b0110000: lambda a, d, m: a,
+    0b1110000: lambda a, d, m: m,
+    0b0001101: lambda a, d, m: ~d & WORD,
+    0b0110001: lambda a, d, m: ~a & WORD,
+    0b1110001: lambda a, d, m: ~m & WORD,
+    0b0001111: lambda a, d, m: -d & WORD,
+    0b0110011: lambda a, d, m: -a & WORD,
+    0b1110011: lambda a, d, m: -m & WORD,
+    0b0011111: lambda a, d, m: (d + 1) & WORD,
+    0b0110111: lambda a, d, m: (a + 1) & WORD,
+    0b1110111: lambda a, d, m: (m + 1) & WORD,
+    0b0001110: lambda a, d, m: (d - 1) & WORD,
+    0b0110010: lambda a, d, m: (a - 1) & WORD,
+    0b1110010: lambda a, d, m: (m - 1) & WORD,
+    0b0000010: lambda a, d, m: (d + a) & WORD,
+    0b1000010: lambda a, d, m: (d + m) & WORD,
+    0b0010011: lambda a, d, m: (d - a) & WORD,
+    0b1010011: lambda a, d, m: (d - m) & WORD,
+    0b0000111: lambda a, d, m: (a - d) & WORD,
+    0b1000111: lambda a, d, m: (m - d) & WORD,
+    0b0000000: lambda a, d, m: d & a,
+    0b1000000: lambda a, d, m: d & m,
+    0b0010101: lambda a, d, m: d | a,
+    0b1010101: lambda a, d, m: d | m
+}
+
+# Jump condition of every jump field, on an unsigned 16-bit ALU output
+JUMP_TESTS = [
+    None,
+    lambda v: 0 < v < 0x8000,  # JGT
+    lambda v: v == 0,  # JEQ
+    lambda v: v < 0x8000,  # JGE
+    lambda v: v >= 0x8000,  # JLT
+    lambda v: v != 0,  # JNE
+    lambda v: v == 0 or v >= 0x8000,  # JLE
+    lambda v: True  # JMP
+]
+
+
+def to_signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class HackCPU:
+    """Hack CPU running a pre-decoded ROM against an array-backed RAM.
+
+    Execution stops at the cycle bound, when the program counter runs past
+    the ROM, or on the halt idiom "(L) @L 0;JMP" (halted is then true).
+    """
+
+    def __init__(self, words, count_pcs=False):
+        self.rom_size = len(words)
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        self.a = self.d = self.pc = 0
+        self.cycles = 0
+        self.halted = False
+        # Executions of every ROM address, when count_pcs (see source_map.py)
+        self.pc_counts = array("Q", bytes(8 * len(words))) if count_pcs else None
+        # Decode every instruction once: A-instructions keep their value, C-instructions their fields
+        self.is_address = array("B", (not word & 0x8000 for word in words))
+        self.values = array("H", (word & 0x7FFF for word in words))
+        self.computations = [COMPUTATIONS.get(word >> 6 & 0x7F) if word & 0x8000 else None for word in words]
+        self.reads_memory = array("B", (bool(word & 0x1000) for word in words))
+        self.dests = array("B", (word >> 3 & 0b111 for word in words))
+        self.jumps = array("B", (word & 0b111 for word in words))
+        for pc, word in enumerate(words):
+            if word & 0x8000 and self.computations[pc] is None:
+                raise ValueError(f"ROM[{pc}]: invalid instruction {word:016b}")
+
+    def set_ram(self, address, value):
+        self.ram[address] = value & WORD
+
+    def get_ram(self, address):
+        """Returns a RAM word as a signed integer"""
+        return to_signed(self.ram[address])
+
+    def run(self, max_cycles):
+        """Executes up to max_cycles instructions and returns the number executed"""
+        ram, is_address, values = self.ram, self.is_address, self.values
+        computations, reads_memory, dests, jumps = self.computations, self.reads_memory, self.dests, self.jumps
+        a, d, pc = self.a, self.d, self.pc
+        rom_size, pc_counts = self.rom_size, self.pc_counts
+        executed = 0
+        while executed < max_cycles:
+            if pc >= rom_size:
+                self.halted = True
+                break
+            executed += 1
+            if pc_counts is not None:
+                pc_counts[pc] += 1
+            if is_address[pc]:
+                a = values[pc]
+                pc += 1
+                continue
+            value = computations[pc](a, d, ram[a & 0x7FFF] if reads_memory[pc] else 0)
+            dest = dests[pc]
+            jump = jumps[pc]
+            target = a
+            if dest & 0b001:
+                ram[a & 0x7FFF] = value
+            if dest & 0b010:
+                d = value
+            if dest & 0b100:
+                a = value
+            if jump and JUMP_TESTS[jump](value):
+                if jump == 7 and not dest and target == pc - 1 and is_address[target] and values[target] == target:
+                    self.halted = True
+                    break
+                pc = target
+            else:
+                pc += 1
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += executed
+        return executed
+
+
+class TestResult:
+    """Outcome of running a .tst script: the output rows and the rows of its .cmp file"""
+
+    def __init__(self, name, columns, outputs, expected, cycles, halted, rom_size, ram=None, pc_counts=None):
+        self.name = name
+        self.columns = columns
+        self.outputs = outputs
+        self.expected = expected
+        self.cycles = cycles
+        self.halted = halted
+        self.rom_size = rom_size
+        self.ram = ram  # Final RAM contents
+        self.pc_counts = pc_counts  # Executions per ROM address, if counted
+
+    @property
+    def passed(self):
+        return self.expected is not None and self.outputs == self.expected
+
+
+def read_cmp(path):
+    """Returns the value rows of a .cmp file as lists of ints"""
+    with open(path) as cmp_file:
+        rows = [line.strip().strip("|").split("|") for line in cmp_file if line.strip()]
+    return [[int(cell) for cell in row] for row in rows[1:]]
+
+
+def read_script(path):
+    """Returns the statements of a .tst script, with comments removed and repeat blocks expanded to counts"""
+    with open(path) as script:
+        text = script.read()
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"//[^\n]*", "", text)
+    text = re.sub(r"repeat\s+(\d+)\s*\{([^}]*)\}",
+                  lambda match: f"ticktock {int(match.group(1)) * match.group(2).count('ticktock')};", text)
+    return [statement.strip() for statement in re.split(r"[,;]", text) if statement.strip()]
+
+
+def run_test(tst_path, asm_path=None, count_pcs=False):
+    """Runs a CPU-emulator .tst script against an assembled program.
+
+    The program (.asm, .hack or packed) defaults to the .asm named after the script; the script's
+    RAM setup, tick counts and output-list are honoured. count_pcs also counts executions per ROM address.
+    """
+    base = os.path.splitext(tst_path)[0]
+    cpu = HackCPU(load_program(asm_path or f"{base}.asm"), count_pcs)
+    result = run_script(tst_path, cpu)
+    result.pc_counts = cpu.pc_counts
+    return result
+
+
+def run_script(tst_path, machine):
+    """Runs a .tst script on a machine with set_ram, get_ram and run(max_cycles), like HackCPU"""
+    base = os.path.splitext(tst_path)[0]
+    columns, outputs = [], []
+    cmp_path = f"{base}.cmp"
+    for statement in read_script(tst_path):
+        words = statement.split()
+        if words[0] == "set" and words[1].startswith("RAM["):
+            machine.set_ram(int(words[1][4:-1]), int(words[2]))
+        elif words[0] == "ticktock":
+            machine.run(int(words[1]) if len(words) > 1 else 1)
+        elif words[0] == "output-list":
+            columns = [int(re.match(r"RAM\[(\d+)\]", word).group(1)) for word in words[1:]]
+        elif words[0] == "output":
+            outputs.append([machine.get_ram(address) for address in columns])
+        elif words[0] == "compare-to":
+            cmp_path = os.path.join(os.path.dirname(tst_path), words[1])
+    expected = read_cmp(cmp_path) if os.path.exists(cmp_path) else None
+    return TestResult(os.path.basename(base), columns, outputs, expected, machine.cycles, machine.halted,
+                      machine.rom_size, machine.ram)
+
+
+def write_ram_dump(path, ram):
+    """Writes the non-zero RAM words as "address value" lines (see profiler.py)"""
+    with open(path, 'w') as dump:
+        for address, value in enumerate(ram):
+            if value:
+                dump.write(f"{address} {value}\n")
+
+
+def write_pc_histogram(path, pc_counts):
+    """Writes the executed ROM addresses as "address count" lines (see source_map.py)"""
+    with open(path, 'w') as histogram:
+        for address, count in enumerate(pc_counts):
+            if count:
+                histogram.write(f"{address} {count}\n")
+
+
+def find_tests(paths):
+    """Expands directories into the CPU-emulator .tst scripts below them (skipping VM-emulator *VME.tst)"""
+    tests = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                tests += [os.path.join(root, f) for f in sorted(files)
+                          if f.endswith(".tst") and not f.endswith("VME.tst")]
+        else:
+            tests.append(path)
+    return tests
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Runs CPU-emulator .tst scripts on their .asm programs")
+    arg_parser.add_argument("paths", nargs="+", help=".tst files or directories containing them")
+    arg_parser.add_argument("--dump-ram", action="store_true",
+                            help="write each test's final RAM next to its script as NAME.ram")
+    arg_parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default="asm",
+                            help="load each program from NAME.asm, NAME.hack or packed NAME.bin (see Main.py --format)")
+    arg_parser.add_argument("--pc-histogram", action="store_true",
+                            help="write how often each ROM address ran next to each script as NAME.pcs")
+    args = arg_parser.parse_args()
+
+    failures = 0
+    print(f"{'test':<20}{'result':>8}{'ROM':>8}{'cycles':>10}")
+    for tst_path in find_tests(args.paths):
+        result = run_test(tst_path, os.path.splitext(tst_path)[0] + OUTPUT_FORMATS[args.format], args.pc_histogram)
+        if args.dump_ram:
+            write_ram_dump(f"{os.path.splitext(tst_path)[0]}.ram", result.ram)
+        if args.pc_histogram:
+            write_pc_histogram(f"{os.path.splitext(tst_path)[0]}.pcs", result.pc_counts)
+        cycles = f"{result.cycles}" + ("" if result.halted else "+")  # + : still running at the cycle bound
+        print(f"{result.name:<20}{'ok' if result.passed else 'FAIL':>8}{result.rom_size:>8}{cycles:>10}")
+        if not result.passed:
+            failures += 1
+            print(f"  got {result.outputs}, expected {result.expected}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,27 @@
+import mmap
+import os
+from vm_ir import Command, Opcode, Segment, ARITHMETIC_OPS, BRANCH_OPS, SOURCE_OPS, SOURCE_SEGMENTS
+
+BUFFER_SIZE = 1 << 20  # Bytes read from disk at a time
+
+
 class Parser:
-    """Read and parses an instruction"""
+    """Read and parses an instruction
 
-    def __init__(self, path):
+    Lines are streamed from the file (through a large read buffer, or an
+    mmap of the file with use_mmap) with one line of lookahead, so memory
+    use does not grow with the size of the file.
+    """
+
+    def __init__(self, path, use_mmap=False):
         self.path = path
-        self.file = open(self.path)
-        self.lines = self.file.readlines()
+        self.use_mmap = use_mmap
+        self.file = open(self.path, 'rb' if use_mmap else 'r', buffering=BUFFER_SIZE)
+        self.source = self.read_lines()
+        self.next_line = next(self.source, None)  # Lookahead for hasMoreLines
         self.index = -1  # Line index of the file (including empty spaces)
         self.line_index = 0  # Line index of the instructions (not including empty spaces)
         self.line = None
-        self.arithmetics = ["add", "sub", "neg", "eq", "and", "or", "not", "gt", "lt"]
-        self.C_ARITHMETIC = "C_ARITHMETIC"
-        self.C_PUSH = "C_PUSH"
-        self.C_POP = "C_POP"
-        self.C_LABEL = "C_LABEL"
-        self.C_GOTO = "C_GOTO"
-        self.C_IF = "C_IF"
-        self.C_FUNCTION = "C_FUNCTION"
-        self.C_RETURN = "C_RETURN"
-        self.C_CALL = "C_CALL"
 
     def __str__(self):
         return self.line
@@ -25,9 +29,28 @@ class Parser:
     def __len__(self):
         return len(self.line)
 
+    def read_lines(self):
+        """Yields the raw lines of the file and closes it once they run out."""
+        try:
+            if self.use_mmap and os.fstat(self.file.fileno()).st_size > 0:
+                with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for raw_line in iter(mapped.readline, b""):
+                        yield raw_line.decode()
+            elif self.use_mmap:
+                return  # An empty file cannot be mapped
+            else:
+                yield from self.file
+        finally:
+            self.file.close()
+
+    def close(self):
+        """Closes the file without reading the rest of it."""
+        self.source.close()
+        self.file.close()
+
     def hasMoreLines(self):
         """Returns true if there are more commands in the file."""
-        return self.index + 1 < len(self.lines)
+        return self.next_line is not None
 
     def advance(self):
         """Reads the next instruction from the file and makes it the current instruction."""
@@ -42,47 +65,45 @@ class Parser:
     def get_next_line(self):
         """Gets the next line, removing comments and whitespace."""
         self.index += 1
-        if self.index >= len(self.lines):
+        dirty_line = self.next_line
+        if dirty_line is None:
             return None
-        dirty_line = self.lines[self.index]
+        self.next_line = next(self.source, None)
         return dirty_line.split("//")[0].strip()  # Remove whitespace and comments
 
-    def command_type(self):
-        """Returns the type of the current command."""
-        if not self.line:
-            return None
-
-        # Get first word of command
-        command = self.line.split(" ")[0]
+    def parse_command(self):
+        """Parses the current line into a Command, splitting it only once."""
+        return parse_line(self.line, self.index + 1, self.path)
 
-        # Check arithmetic commands
-        if command in self.arithmetics:
-            return self.C_ARITHMETIC
+    def iter_commands(self):
+        """Yields every remaining command of the file as a Command, one line at a time."""
+        while self.hasMoreLines():
+            self.advance()
+            if not self.line:  # Skip empty lines
+                continue
+            yield self.parse_command()
 
-        # Map commands to their types
-        command_types = {
-            'push': self.C_PUSH,
-            'pop': self.C_POP,
-            'label': self.C_LABEL,
-            'goto': self.C_GOTO,
-            'if-goto': self.C_IF,
-            'function': self.C_FUNCTION,
-            'return': self.C_RETURN,
-            'call': self.C_CALL
-        }
+    def commands(self):
+        """Parses every remaining command of the file into a list of Commands."""
+        return list(self.iter_commands())
 
-        return command_types.get(command)
 
-
-    def arg1(self):
-        if self.command_type() == self.C_RETURN:
-            return None
-        if self.command_type() == self.C_ARITHMETIC:
-            return self.line.split(" ")[0]
-        else:
-            return self.line.split(" ")[1]
-
-    def arg2(self):
-        if self.command_type() in [self.C_PUSH, self.C_POP, self.C_FUNCTION, self.C_CALL]:
-            return int(self.line.split(" ")[2])
-        return None
+def parse_line(line, line_number=0, path="<vm>"):
+    """Parses one stripped, comment-free VM line into a Command"""
+    words = line.split()
+    try:
+        op = Opcode(words[0])
+        if op not in SOURCE_OPS:
+            raise ValueError(f"{op.value} is internal to the translator")
+        if op in ARITHMETIC_OPS or op == Opcode.RETURN:
+            return Command(op, line_number=line_number)
+        if op in BRANCH_OPS:
+            return Command(op, name=words[1], line_number=line_number)
+        if op in (Opcode.PUSH, Opcode.POP):
+            segment = Segment(words[1])
+            if segment not in SOURCE_SEGMENTS:
+                raise ValueError(f"{segment.value} is internal to the translator")
+            return Command(op, segment=segment, index=int(words[2]), line_number=line_number)
+        return Command(op, name=words[1], index=int(words[2]), line_number=line_number)
+    except (ValueError, IndexError):
+        raise ValueError(f"{path}:{line_number}: invalid VM command '{line}'")
@@ -0,0 +1,122 @@
+from time import perf_counter
+from call_optimizer import INLINE_THRESHOLD
+from vm_ir import PROLOGUE_LOOP_MIN_LOCALS
+
+# Transformation passes in pipeline order: VM passes rewrite a file's parsed commands,
+# assembly passes the lines generated from them
+VM_PASSES = ["dead-functions", "inline", "tail-calls", "jumps", "fold", "fuse"]
+ASSEMBLY_PASSES = ["peephole"]
+PASSES = VM_PASSES + ASSEMBLY_PASSES
+
+# VMTranslator options turned on by each optimisation level, on top of the ones given explicitly
+OPT_LEVELS = {
+    "0": {},
+    "1": {"vm_optimize": True, "peephole": True, "thread_jumps": True, "segment_cache": True},
+    "2": {"vm_optimize": True, "peephole": True, "thread_jumps": True, "segment_cache": True, "tos_cache": True,
+          "dead_functions": True, "tail_calls": True, "inline_threshold": INLINE_THRESHOLD},
+    "s": {"vm_optimize": True, "peephole": True, "thread_jumps": True, "segment_cache": True, "tos_cache": True,
+          "dead_functions": True, "shared_calls": True, "shared_compare": True,
+          "prologue_loop": PROLOGUE_LOOP_MIN_LOCALS}
+}
+
+
+_DONE = object()  # End of a measured command stream
+
+
+def is_instruction(line):
+    """Returns true for assembly lines that occupy a ROM word (not labels, comments or blanks)"""
+    line = line.strip()
+    return bool(line) and not line.startswith(("//", "("))
+
+
+class PassManager:
+    """Runs a translator's transformation passes in order, timing each one and counting what it changes.
+
+    VM passes are chained generators over a file's commands, so the time of
+    a VM pass is the time spent producing its output minus the time its
+    input took to produce. Assembly passes rewrite a file's lines in turn.
+    """
+
+    def __init__(self):
+        self.vm_passes = []  # (name, function(commands) -> commands), in order
+        self.assembly_passes = []  # (name, function(lines) -> lines), in order
+        # name -> {"seconds", "in", "out"}: VM passes count commands out (their input is the previous
+        # stage's output), assembly passes count instructions in and out
+        self.stats = {}
+
+    def add_vm_pass(self, name, function):
+        self.vm_passes.append((name, function))
+
+    def add_assembly_pass(self, name, function):
+        self.assembly_passes.append((name, function))
+
+    def entry(self, name):
+        """Returns the statistics of one pass (or stage), creating them on first use"""
+        return self.stats.setdefault(name, {"seconds": 0.0, "in": 0, "out": 0})
+
+    def add_time(self, name, seconds):
+        """Charges whole-program analysis time to the pass that needs it"""
+        self.entry(name)["seconds"] += seconds
+
+    def run_vm(self, commands):
+        """Returns an iterator over the commands after every VM pass"""
+        if not self.vm_passes:
+            return commands
+        clock = [0.0]  # Time spent producing the current stage's output, its input included
+        stage = self.measure(commands, self.entry("parse"), clock, None)
+        for name, function in self.vm_passes:
+            upstream, clock = clock, [0.0]
+            stage = self.measure(function(stage), self.entry(name), clock, upstream)
+        return stage
+
+    @staticmethod
+    def measure(commands, entry, clock, upstream):
+        """Yields the commands, charging the time taken to produce them to entry, less the upstream clock's share"""
+        iterator = iter(commands)
+        while True:
+            upstream_before = upstream[0] if upstream else 0.0
+            start = perf_counter()
+            command = next(iterator, _DONE)
+            elapsed = perf_counter() - start
+            clock[0] += elapsed
+            entry["seconds"] += elapsed - ((upstream[0] - upstream_before) if upstream else 0.0)
+            if command is _DONE:
+                return
+            entry["out"] += 1
+            yield command
+
+    def optimize(self, lines):
+        """Returns a file's assembly after every assembly pass"""
+        for name, function in self.assembly_passes:
+            entry = self.entry(name)
+            start = perf_counter()
+            entry["in"] += sum(1 for line in lines if is_instruction(line))
+            lines = function(lines)
+            entry["out"] += sum(1 for line in lines if is_instruction(line))
+            entry["seconds"] += perf_counter() - start
+        return lines
+
+    def merge(self, stats):
+        """Adds statistics collected by another PassManager (a worker's)"""
+        for name, other in stats.items():
+            entry = self.entry(name)
+            for field, value in other.items():
+                entry[field] += value
+
+    def report(self):
+        """Returns one line per pass with its run time and the items (commands or instructions) in and out"""
+        lines = [f"{'pass':<16}{'ms':>10}{'in':>10}{'out':>10}"]
+        previous = None
+        for name in ["parse"] + [name for name, _ in self.vm_passes]:
+            if name in self.stats:
+                entry = self.stats[name]
+                items_in = f"{previous['out']:>10}" if previous else f"{'':>10}"
+                lines.append(f"{name:<16}{entry['seconds'] * 1000:>10.2f}{items_in}{entry['out']:>10}")
+                previous = entry
+        for name, _ in self.assembly_passes:
+            if name in self.stats:
+                entry = self.stats[name]
+                lines.append(f"{name:<16}{entry['seconds'] * 1000:>10.2f}{entry['in']:>10}{entry['out']:>10}")
+        total = sum(entry["seconds"] for entry in self.stats.values())
+        lines.append(f"{'total':<16}{total * 1000:>10.2f}")
+        return "\n".join(lines)
@@ -0,0 +1,218 @@
+# Registers with a fixed address, so "@SP" and "@R0" are recognised as the same location
+PREDEFINED_SYMBOLS = {"SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4}
+PREDEFINED_SYMBOLS.update({f"R{i}": i for i in range(16)})
+SP_ADDRESS = 0
+
+
+def is_code(line):
+    """Returns true if the line is an instruction or a label (not a comment or blank line)"""
+    stripped = line.strip()
+    return bool(stripped) and not stripped.startswith("//")
+
+
+def canonical_address(symbol):
+    """Returns the address a symbol refers to when it is known, else the symbol itself"""
+    if symbol.isdigit():
+        return int(symbol)
+    return PREDEFINED_SYMBOLS.get(symbol, symbol)
+
+
+def split_instruction(line):
+    """Splits a C-instruction into (dest, comp, jump)"""
+    dest, comp, jump = "", line, ""
+    if "=" in comp:
+        dest, comp = comp.split("=", 1)
+    if ";" in comp:
+        comp, jump = comp.split(";", 1)
+    return dest, comp, jump
+
+
+def sp_inc_dec(lines):
+    """Removes a stack pointer increment immediately followed by a decrement.
+
+    "@SP / M=M+1 / @SP / AM=M-1" leaves SP unchanged and A pointing at the
+    cell just pushed, which is exactly "@SP / A=M".
+    """
+    code = [i for i, line in enumerate(lines) if is_code(line)]
+    dropped = set()
+    k = 0
+    while k + 2 < len(code):
+        first, second = lines[code[k]], lines[code[k + 1]]
+        if first == "@SP" and second == "M=M+1":
+            if lines[code[k + 2]] == "AM=M-1":
+                lines[code[k + 1]] = "A=M"
+                dropped.add(code[k + 2])
+                k += 3
+                continue
+            if k + 3 < len(code) and lines[code[k + 2]] == "@SP" and lines[code[k + 3]] == "AM=M-1":
+                lines[code[k + 1]] = "A=M"
+                dropped.update([code[k + 2], code[k + 3]])
+                k += 4
+                continue
+        k += 1
+    return [line for i, line in enumerate(lines) if i not in dropped], len(dropped)
+
+
+class _RegisterState:
+    """What is known about A and D at a point of a basic block.
+
+    address is ("const", X) when A holds address X, or ("deref", X) when A
+    holds the current value of RAM[X]. d_is_m is true when D equals RAM[A].
+    Writes through the stack pointer are assumed never to hit R0-R15, since
+    the stack always lives above them.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.address = None
+        self.d_is_m = False
+
+    def load(self, symbol):
+        self.address = ("const", canonical_address(symbol))
+        self.d_is_m = False
+
+    def execute(self, line):
+        dest, comp, jump = split_instruction(line)
+        if jump == "JMP":  # Only reachable again through a label
+            self.reset()
+            return
+
+        if "M" in dest and self.address is not None:
+            kind, target = self.address
+            if kind == "deref" and target != SP_ADDRESS:
+                self.address = None  # RAM[target] itself may have been overwritten
+
+        if "A" in dest:
+            if comp in ("M", "M+1", "M-1") and "M" in dest and self.address and self.address[0] == "const":
+                self.address = ("deref", self.address[1])  # AM=M±1: A is the new RAM[X]
+            elif comp == "M" and "M" not in dest and self.address and self.address[0] == "const":
+                self.address = ("deref", self.address[1])
+            else:
+                self.address = None
+
+        if "A" in dest:
+            self.d_is_m = "D" in dest and "M" in dest
+        elif "D" in dest and "M" in dest:
+            self.d_is_m = True
+        elif "D" in dest:
+            self.d_is_m = comp == "M"
+        elif "M" in dest:
+            self.d_is_m = comp == "D"
+
+
+def _drop_known_values(lines, drop_loads, drop_copies):
+    """Walks each basic block and drops instructions whose result is already in A or D"""
+    state = _RegisterState()
+    result = []
+    removed = 0
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not is_code(line):
+            result.append(line)
+            i += 1
+            continue
+
+        if line.startswith("("):
+            state.reset()
+        elif line.startswith("@"):
+            address = ("const", canonical_address(line[1:]))
+            if drop_loads and state.address == address:
+                removed += 1
+                i += 1
+                continue
+            following = next((j for j in range(i + 1, len(lines)) if is_code(lines[j])), None)
+            if (drop_loads and following is not None and lines[following] == "A=M"
+                    and state.address == ("deref", address[1])):
+                result.extend(lines[i + 1:following])  # Keep comments in between
+                removed += 2
+                i = following + 1
+                continue
+            state.load(line[1:])
+        else:
+            if drop_copies and state.d_is_m and line in ("D=M", "M=D"):
+                removed += 1
+                i += 1
+                continue
+            state.execute(line)
+
+        result.append(line)
+        i += 1
+    return result, removed
+
+
+def redundant_load(lines):
+    """Removes "@X" (and "@X / A=M") when A already holds that address"""
+    return _drop_known_values(lines, drop_loads=True, drop_copies=False)
+
+
+def store_reload(lines):
+    """Removes "D=M" or "M=D" when D and RAM[A] are already equal"""
+    return _drop_known_values(lines, drop_loads=False, drop_copies=True)
+
+
+def dead_d(lines):
+    """Removes "D=..." assignments overwritten before D is read in the same basic block"""
+    code = [i for i, line in enumerate(lines) if is_code(line)]
+    dropped = set()
+    for k, i in enumerate(code):
+        line = lines[i]
+        if line.startswith(("@", "(")):
+            continue
+        dest, comp, jump = split_instruction(line)
+        if dest != "D" or jump:
+            continue
+        for m in range(k + 1, len(code)):
+            j = code[m]
+            following = lines[j]
+            if following.startswith("("):
+                break  # D may be read after a jump to this label
+            if following.startswith("@"):
+                continue
+            next_dest, next_comp, next_jump = split_instruction(following)
+            if "D" in next_comp or next_jump:
+                break
+            if "D" in next_dest:
+                dropped.add(i)
+                break
+    return [line for i, line in enumerate(lines) if i not in dropped], len(dropped)
+
+
+# Rules are applied in order, repeatedly, until none of them removes anything
+RULES = [
+    ("sp-inc-dec", sp_inc_dec),
+    ("redundant-load", redundant_load),
+    ("store-reload", store_reload),
+    ("dead-d", dead_d),
+]
+
+
+class Peephole:
+    """Rewrites a list of Hack assembly lines with a table of (name, rule) pairs.
+
+    Each rule takes the lines and returns (new_lines, instructions_removed).
+    """
+
+    def __init__(self, rules=None):
+        self.rules = RULES if rules is None else rules
+        self.removed = {name: 0 for name, _ in self.rules}
+
+    def optimize(self, lines):
+        lines = list(lines)
+        changed = True
+        while changed:
+            changed = False
+            for name, rule in self.rules:
+                lines, removed = rule(lines)
+                if removed:
+                    self.removed[name] += removed
+                    changed = True
+        return lines
+
+    def report(self):
+        """Returns one line per rule with the number of instructions it removed"""
+        lines = [f"{name:<16}{removed:>8}" for name, removed in self.removed.items()]
+        lines.append(f"{'total':<16}{sum(self.removed.values()):>8}")
+        return "\n".join(lines)
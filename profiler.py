@@ -0,0 +1,92 @@
+"""Hot-function report of a profiling build.
+
+Usage: python3 profiler.py PROGRAM.profile.json RAM_DUMP
+The RAM dump is either a CPU-emulator .out file whose output-list includes
+the counter cells, or an "address value" per line dump (hack_emulator.py
+--dump-ram writes one next to each test as NAME.ram). Counters are 16-bit
+and wrap; functions inlined by --inline are never entered, so they count 0.
+They sit with the variables, right after the program's static cells, so a
+profiled program keeps its statics, heap and screen where they were.
+"""
+import argparse
+import json
+import os
+import re
+from hack_assembler import FIRST_VARIABLE_ADDRESS
+
+PROFILE_END = 256  # The counters must not reach into the stack
+
+
+def profile_layout(functions, call_sites, statics=0):
+    """Assigns a RAM counter to every function and call site, after the program's static cells.
+
+    statics is the number of distinct static cells, which the assembler
+    places from FIRST_VARIABLE_ADDRESS on. call_sites are (site, caller,
+    callee) tuples, site being "File.vm:line".
+    """
+    base = FIRST_VARIABLE_ADDRESS + statics
+    if base + len(functions) + len(call_sites) > PROFILE_END:
+        raise ValueError(f"{len(functions) + len(call_sites)} profile counters and {statics} static cells "
+                         f"do not fit below the stack at {PROFILE_END}")
+    layout = {"functions": {}, "call_sites": {}}
+    for address, function_name in enumerate(functions, base):
+        layout["functions"][function_name] = address
+    for address, (site, caller, callee) in enumerate(call_sites, base + len(functions)):
+        layout["call_sites"][site] = {"caller": caller, "callee": callee, "address": address}
+    return layout
+
+
+def profile_map_path(output_file):
+    """Returns the symbol map written next to a profiling build's .asm file"""
+    return os.path.splitext(output_file)[0] + ".profile.json"
+
+
+def read_ram_dump(path):
+    """Returns {address: unsigned value} from a .out table (its last row) or an "address value" dump"""
+    with open(path) as dump:
+        lines = [line.strip() for line in dump if line.strip()]
+    if path.endswith(".out"):
+        header = [cell.strip() for cell in lines[0].strip("|").split("|")]
+        values = [cell.strip() for cell in lines[-1].strip("|").split("|")]
+        addresses = [int(re.match(r"RAM\[(\d+)\]", cell).group(1)) for cell in header]
+        return {address: int(value) & 0xFFFF for address, value in zip(addresses, values)}
+    ram = {}
+    for line in lines:
+        address, value = line.split()
+        ram[int(address)] = int(value) & 0xFFFF
+    return ram
+
+
+def report(layout, ram):
+    """Returns the hot-function table, and the hot call sites if the build counted them"""
+    counts = [(ram.get(address, 0), name) for name, address in layout["functions"].items()]
+    counts.sort(key=lambda item: (-item[0], item[1]))
+    total = sum(count for count, _ in counts) or 1
+    lines = [f"{'function':<32}{'calls':>10}{'%':>8}"]
+    for count, name in counts:
+        lines.append(f"{name:<32}{count:>10}{100 * count / total:>8.1f}")
+
+    if layout["call_sites"]:
+        sites = [(ram.get(site["address"], 0), name, site) for name, site in layout["call_sites"].items()]
+        sites.sort(key=lambda item: (-item[0], item[1]))
+        lines.append("")
+        lines.append(f"{'call site':<24}{'caller -> callee':<40}{'calls':>10}")
+        for count, name, site in sites:
+            route = f"{site['caller'] or '(top level)'} -> {site['callee']}"
+            lines.append(f"{name:<24}{route:<40}{count:>10}")
+    return "\n".join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("profile_map", help="the .profile.json written by Main.py --profile")
+    arg_parser.add_argument("ram_dump", help="a CPU-emulator .out file or an 'address value' RAM dump")
+    args = arg_parser.parse_args()
+
+    with open(args.profile_map) as profile_map:
+        layout = json.load(profile_map)
+    print(report(layout, read_ram_dump(args.ram_dump)))
+
+
+if __name__ == "__main__":
+    main()
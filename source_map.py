@@ -0,0 +1,154 @@
+"""Hot-line report: folds an executed-PC histogram into cycles per VM line and per function.
+
+Usage: python3 source_map.py PROGRAM.map.json PROGRAM.pcs [--top N]
+The source map is written next to the output by Main.py --source-map; it
+maps ROM address ranges to the VM file, line and function they were
+translated from. The histogram is an "address count" per line file, as
+written by hack_emulator.py --pc-histogram (NAME.pcs next to each test).
+Addresses of the bootstrap and shared routines are reported under their
+own names ($bootstrap, $$CALL, ...).
+"""
+import argparse
+import json
+import os
+from bisect import bisect_right
+from pass_manager import is_instruction
+
+SOURCE_MARK = "//@ "  # Comment carrying "file:line function" to the instructions after it, through the optimizer
+
+
+def source_mark(source, line_number, function_name):
+    """Returns the marker line attributing the following instructions to a VM line"""
+    return f"{SOURCE_MARK}{source}:{line_number} {function_name or ''}"
+
+
+def source_map_path(output_file):
+    """Returns the source map written next to a build's output file"""
+    return os.path.splitext(output_file)[0] + ".map.json"
+
+
+class SourceMap:
+    """ROM address ranges and the (source, line, function) each was translated from.
+
+    feed() takes the final assembly in output order, drops the marker lines
+    and numbers the instructions as the assembler will.
+    """
+
+    def __init__(self):
+        self.ranges = []  # [start, end, source, line, function], end exclusive, in address order
+        self.address = 0  # ROM address of the next instruction fed
+        self.position = None  # (source, line, function) of the instructions being fed
+
+    def feed(self, lines):
+        """Records the positions of the instructions among lines and returns lines without the markers"""
+        kept = []
+        for line in lines:
+            if line.startswith(SOURCE_MARK):
+                location, _, function_name = line[len(SOURCE_MARK):].partition(" ")
+                source, _, line_number = location.rpartition(":")
+                self.position = (source, int(line_number), function_name or None)
+                continue
+            kept.append(line)
+            if not is_instruction(line):
+                continue
+            last = self.ranges[-1] if self.ranges else None
+            if last and last[1] == self.address and tuple(last[2:]) == self.position:
+                last[1] += 1
+            elif self.position:
+                self.ranges.append([self.address, self.address + 1, *self.position])
+            self.address += 1
+        return kept
+
+    def save(self, path):
+        """Writes the map as JSON, with source and function names listed once and ranges indexing them"""
+        sources = sorted({source for _, _, source, _, _ in self.ranges})
+        functions = sorted({function_name for _, _, _, _, function_name in self.ranges if function_name})
+        source_ids = {source: i for i, source in enumerate(sources)}
+        function_ids = {function_name: i for i, function_name in enumerate(functions)}
+        ranges = [[start, end, source_ids[source], line_number, function_ids.get(function_name, -1)]
+                  for start, end, source, line_number, function_name in self.ranges]
+        with open(path, 'w') as map_file:
+            json.dump({"sources": sources, "functions": functions, "ranges": ranges}, map_file,
+                      separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as map_file:
+            data = json.load(map_file)
+        source_map = cls()
+        source_map.ranges = [[start, end, data["sources"][source], line_number,
+                              data["functions"][function_id] if function_id >= 0 else None]
+                             for start, end, source, line_number, function_id in data["ranges"]]
+        return source_map
+
+
+def read_pc_histogram(path):
+    """Returns {ROM address: times executed} from an "address count" per line file"""
+    histogram = {}
+    with open(path) as histogram_file:
+        for line in histogram_file:
+            if line.strip():
+                address, count = line.split()
+                histogram[int(address)] = int(count)
+    return histogram
+
+
+def fold(source_map, histogram):
+    """Returns ({(source, line): cycles}, {function: cycles}) of an executed-PC histogram"""
+    starts = [start for start, *_ in source_map.ranges]
+    lines, functions = {}, {}
+    for address, count in histogram.items():
+        i = bisect_right(starts, address) - 1
+        if i >= 0 and address < source_map.ranges[i][1]:
+            _, _, source, line_number, function_name = source_map.ranges[i]
+        else:
+            source, line_number, function_name = "(unmapped)", 0, None
+        lines[(source, line_number)] = lines.get((source, line_number), 0) + count
+        function_name = function_name or source  # Top-level code and routines count under their source
+        functions[function_name] = functions.get(function_name, 0) + count
+    return lines, functions
+
+
+def read_source_lines(source_dir, sources):
+    """Returns {source: its lines} for the VM files found in source_dir"""
+    texts = {}
+    for source in sources:
+        path = os.path.join(source_dir, source)
+        if source.endswith(".vm") and os.path.isfile(path):
+            with open(path) as vm_file:
+                texts[source] = [line.split("//")[0].strip() for line in vm_file]
+    return texts
+
+
+def report(line_cycles, function_cycles, texts=None, top=20):
+    """Returns the hottest functions and VM lines, with their share of all cycles"""
+    texts = texts or {}
+    total = sum(function_cycles.values()) or 1
+    lines = [f"{'function':<32}{'cycles':>12}{'%':>8}"]
+    for name, cycles in sorted(function_cycles.items(), key=lambda item: (-item[1], item[0]))[:top]:
+        lines.append(f"{name:<32}{cycles:>12}{100 * cycles / total:>8.1f}")
+    lines.append("")
+    lines.append(f"{'VM line':<24}{'cycles':>12}{'%':>8}  command")
+    for (source, line_number), cycles in sorted(line_cycles.items(), key=lambda item: (-item[1], item[0]))[:top]:
+        text = texts.get(source, [])
+        command = text[line_number - 1] if 0 < line_number <= len(text) else ""
+        lines.append(f"{f'{source}:{line_number}':<24}{cycles:>12}{100 * cycles / total:>8.1f}  {command}")
+    return "\n".join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("source_map", help="the .map.json written by Main.py --source-map")
+    arg_parser.add_argument("histogram", help="the executed-PC histogram written by hack_emulator.py --pc-histogram")
+    arg_parser.add_argument("--top", type=int, default=20, help="functions and lines to list (default: 20)")
+    args = arg_parser.parse_args()
+
+    source_map = SourceMap.load(args.source_map)
+    line_cycles, function_cycles = fold(source_map, read_pc_histogram(args.histogram))
+    texts = read_source_lines(os.path.dirname(os.path.abspath(args.source_map)),
+                              {source for source, _ in line_cycles})
+    print(report(line_cycles, function_cycles, texts, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+
+# Modules whose source decides what a .vm file translates to
+TRANSLATOR_MODULES = ["parser.py", "vm_ir.py", "vm_optimizer.py", "call_graph.py", "call_optimizer.py", "control_flow.py",
+                      "code_writer.py", "peephole.py", "pass_manager.py", "profiler.py", "source_map.py",
+                      "vm_translator.py"]
+
+CACHE_DIR_NAME = ".vmcache"
+
+
+def translator_version():
+    """Returns a hash of the translator's own source, so editing it invalidates every cached fragment"""
+    digest = hashlib.sha256()
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in TRANSLATOR_MODULES:
+        with open(os.path.join(base_dir, module), 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+class TranslationCache:
+    """On-disk store of translated fragments keyed by file content, file name, translator version and options"""
+
+    def __init__(self, cache_dir, options):
+        self.cache_dir = cache_dir
+        self.salt = json.dumps([translator_version(), options], sort_keys=True)
+        self.hits = []
+        self.misses = []
+
+    def key(self, input_file):
+        """Returns the cache key of a .vm file (its name matters: it scopes statics and labels)"""
+        digest = hashlib.sha256(self.salt.encode())
+        digest.update(os.path.basename(input_file).encode())
+        with open(input_file, 'rb') as source:
+            digest.update(source.read())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, input_file, key):
+        """Returns the cached fragment fields of a file as a dict, or None on a miss"""
+        try:
+            with open(self.path(key)) as entry:
+                fields = json.load(entry)
+        except (OSError, ValueError):
+            self.misses.append(input_file)
+            return None
+        self.hits.append(input_file)
+        return fields
+
+    def put(self, key, fields):
+        """Stores fragment fields, writing through a temporary file so readers never see a partial entry"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temporary_path = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as entry:
+            json.dump(fields, entry)
+        os.replace(temporary_path, self.path(key))
+
+    def report(self):
+        """Returns the cache hit and miss counts followed by the files that were retranslated"""
+        lines = [f"{'cache hits':<16}{len(self.hits):>8}", f"{'cache misses':<16}{len(self.misses):>8}"]
+        lines += [f"  retranslated {os.path.basename(f)}" for f in self.misses]
+        return "\n".join(lines)
+
+
+class MemoryCache(TranslationCache):
+    """In-process store of translated fragments for a long-running translator (see translation_daemon.py).
+
+    A file's entry is keyed by its modification time and size instead of a
+    hash of its content, so an unchanged file costs one stat. Only the
+    latest entry of each file is kept.
+    """
+
+    def __init__(self, entries, options):
+        super().__init__(None, options)
+        self.entries = entries  # input file -> (key, fragment fields), kept by the caller between translations
+
+    def key(self, input_file):
+        status = os.stat(input_file)
+        return input_file, status.st_mtime_ns, status.st_size, self.salt
+
+    def get(self, input_file, key):
+        entry = self.entries.get(input_file)
+        if entry is None or entry[0] != key:
+            self.misses.append(input_file)
+            return None
+        self.hits.append(input_file)
+        return entry[1]
+
+    def put(self, key, fields):
+        self.entries[key[0]] = (key, fields)
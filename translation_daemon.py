@@ -0,0 +1,160 @@
+"""Long-running translator: keeps each program's translated files in memory and retranslates only what changed.
+
+Usage: python3 translation_daemon.py [translation flags] [--watch DIR ...] [--socket PATH]
+Requests are program paths (a .vm file or a directory), one per line, read
+from stdin or from connections to the Unix socket PATH; each gets one JSON
+line back. --watch also rebuilds the given programs whenever one of their
+.vm files is added, removed or modified, printing the same JSON lines;
+without --socket, requests are still read from stdin and the daemon stops
+when it closes.
+The translation flags are those of Main.py, but for --stats.
+"""
+import argparse
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from Main import add_translator_arguments, translator_options
+from vm_translator import VMTranslator
+
+WATCH_INTERVAL = 0.2  # Seconds between two scans of the watched directories
+
+
+def program_state(path):
+    """Returns what a rebuild depends on: the program's .vm files with their modification times and sizes"""
+    if not os.path.isdir(path):
+        status = os.stat(path)
+        return {path: (status.st_mtime_ns, status.st_size)}
+    state = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".vm") and entry.is_file():
+                status = entry.stat()
+                state[entry.name] = (status.st_mtime_ns, status.st_size)
+    return state
+
+
+class TranslationDaemon:
+    """Translates programs on request, reusing the fragments of files unchanged since the last build.
+
+    Every program keeps its own fragment store (a MemoryCache), so a build
+    only parses and translates the modified files and then relinks the
+    output. Whole-program analyses (dead functions, inlining) still read
+    every file; their results are part of the cache key, so a change that
+    affects them retranslates the files it affects.
+    """
+
+    def __init__(self, options):
+        self.options = options  # VMTranslator keyword arguments
+        self.fragments = {}  # program path -> MemoryCache entries
+        self.lock = threading.Lock()  # Builds run one at a time, whichever interface asked for them
+        self.response_lock = threading.Lock()  # Replies are whole lines, even when the watcher shares stdout
+
+    def build(self, path):
+        """Translates one program and returns the outcome as a dict (see the module docstring)"""
+        path = os.path.abspath(path.rstrip("/"))
+        start = time.perf_counter()
+        if not os.path.isdir(path) and not (path.endswith(".vm") and os.path.isfile(path)):
+            # The output would be written over the path itself
+            return {"path": path, "ok": False, "error": "not a .vm file or a directory", "ms": 0.0}
+        with self.lock:
+            try:
+                translator = VMTranslator(path, memory_cache=self.fragments.setdefault(path, {}), **self.options)
+                translator.translate()
+            except Exception as error:  # A bad program must not take the daemon down
+                return {"path": path, "ok": False, "error": str(error),
+                        "ms": round((time.perf_counter() - start) * 1000, 3)}
+        return {
+            "path": path,
+            "ok": True,
+            "output": translator.output_file,
+            "retranslated": [os.path.basename(f) for f in translator.cache.misses],
+            "reused": len(translator.cache.hits),
+            "ms": round((time.perf_counter() - start) * 1000, 3)
+        }
+
+    def respond(self, responses, result):
+        """Writes one reply as a JSON line"""
+        with self.response_lock:
+            responses.write(json.dumps(result) + "\n")
+            responses.flush()
+
+    def serve_lines(self, requests, responses):
+        """Answers each non-empty request line with a JSON line, until the requests run out"""
+        for line in requests:
+            path = line.strip()
+            if not path:
+                continue
+            self.respond(responses, self.build(path))
+
+    def watch(self, paths, responses, interval=WATCH_INTERVAL):
+        """Rebuilds each program whenever its .vm files change (forever)"""
+        states = {}
+        while True:
+            for path in paths:
+                try:
+                    state = program_state(path)
+                except OSError:
+                    state = None
+                if state != states.get(path, ()):
+                    states[path] = state
+                    self.respond(responses, self.build(path))
+            time.sleep(interval)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        requests = (line.decode() for line in self.rfile)
+        self.server.translation_daemon.serve_lines(requests, _SocketWriter(self.wfile))
+
+
+class _SocketWriter:
+    """Text writer over a connection's binary stream"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.write(text.encode())
+
+    def flush(self):
+        self.stream.flush()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_translator_arguments(arg_parser, stats=False)
+    arg_parser.add_argument("--watch", nargs="+", default=[], metavar="DIR",
+                            help="program directories (or .vm files) to rebuild whenever they change")
+    arg_parser.add_argument("--interval", type=float, default=WATCH_INTERVAL,
+                            help=f"seconds between scans of the watched programs (default: {WATCH_INTERVAL})")
+    arg_parser.add_argument("--socket", metavar="PATH",
+                            help="take requests on this Unix socket instead of stdin")
+    args = arg_parser.parse_args()
+
+    daemon = TranslationDaemon(translator_options(args))
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Clean up the socket when the build tool stops us
+    if args.watch:
+        watcher = threading.Thread(target=daemon.watch, args=(args.watch, sys.stdout, args.interval), daemon=True)
+        watcher.start()
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        with socketserver.ThreadingUnixStreamServer(args.socket, _RequestHandler) as server:
+            server.translation_daemon = daemon
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(args.socket)
+    else:
+        daemon.serve_lines(sys.stdin, sys.stdout)  # Alongside the watcher, if any: both answer on stdout
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import json
+from time import perf_counter
+from vm_ir import Opcode, ARITHMETIC_OPS
+
+# CodeWriter method generating each VM command, the categories code generation time is reported in
+WRITER_METHODS = {op: "writeArithmetic" for op in ARITHMETIC_OPS}
+WRITER_METHODS.update({
+    Opcode.PUSH: "writePushPop",
+    Opcode.POP: "writePushPop",
+    Opcode.MOVE: "writeMove",
+    Opcode.DROP: "writeDrop",
+    Opcode.LABEL: "writeLabel",
+    Opcode.GOTO: "writeGoto",
+    Opcode.IF_GOTO: "writeIf",
+    Opcode.IF_NOT_GOTO: "writeIf",
+    Opcode.FUNCTION: "writeFunction",
+    Opcode.CALL: "writeCall",
+    Opcode.TAIL_CALL: "writeTailCall",
+    Opcode.RETURN: "writeReturn"
+})
+
+TOP_LEVEL = "(top level)"  # Function name of commands outside any function, and of the bootstrap
+
+
+class TranslationStats:
+    """Stage timings and instruction counts of a translation, reported as JSON by --stats.
+
+    Instructions are counted as the CodeWriter emits them, before any
+    assembly pass; the size of the finished output is reported separately.
+    """
+
+    def __init__(self):
+        self.seconds = {}  # stage -> seconds
+        self.codegen_seconds = {}  # CodeWriter method -> seconds
+        self.commands = {}  # VM command type -> {"commands", "instructions"}
+        self.functions = {}  # function name -> instructions
+        self.files = {}  # file name -> instructions
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def timed(self, stage, items):
+        """Yields the items, charging the time taken to produce them to stage"""
+        iterator = iter(items)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, perf_counter() - start)
+                return
+            self.add_time(stage, perf_counter() - start)
+            yield item
+
+    def record(self, command_type, method, function_name, filename, seconds, instructions):
+        """Records the code generated for one VM command (or the bootstrap)"""
+        self.codegen_seconds[method] = self.codegen_seconds.get(method, 0.0) + seconds
+        entry = self.commands.setdefault(command_type, {"commands": 0, "instructions": 0})
+        entry["commands"] += 1
+        entry["instructions"] += instructions
+        function_name = function_name or TOP_LEVEL
+        self.functions[function_name] = self.functions.get(function_name, 0) + instructions
+        self.files[filename] = self.files.get(filename, 0) + instructions
+
+    def as_dict(self):
+        """Returns the collected statistics as plain data, as passed back from worker processes"""
+        return {"seconds": self.seconds, "codegen_seconds": self.codegen_seconds, "commands": self.commands,
+                "functions": self.functions, "files": self.files}
+
+    def merge(self, stats):
+        """Adds statistics collected by another TranslationStats (a worker's), given as_dict"""
+        for stage, seconds in stats["seconds"].items():
+            self.add_time(stage, seconds)
+        for method, seconds in stats["codegen_seconds"].items():
+            self.codegen_seconds[method] = self.codegen_seconds.get(method, 0.0) + seconds
+        for command_type, counts in stats["commands"].items():
+            entry = self.commands.setdefault(command_type, {"commands": 0, "instructions": 0})
+            entry["commands"] += counts["commands"]
+            entry["instructions"] += counts["instructions"]
+        for function_name, instructions in stats["functions"].items():
+            self.functions[function_name] = self.functions.get(function_name, 0) + instructions
+        for filename, instructions in stats["files"].items():
+            self.files[filename] = self.files.get(filename, 0) + instructions
+
+    def report(self, **fields):
+        """Returns the JSON report, with the given fields (input, output, passes, ...) first"""
+        def ms(seconds):
+            return round(seconds * 1000, 3)
+
+        timings = {stage: ms(seconds) for stage, seconds in self.seconds.items()}
+        timings["codegen"] = {method: ms(seconds) for method, seconds in sorted(self.codegen_seconds.items())}
+        report = dict(fields)
+        report["timings_ms"] = timings
+        report["instructions"] = {
+            "by_command": dict(sorted(self.commands.items(), key=lambda item: -item[1]["instructions"])),
+            "by_function": dict(sorted(self.functions.items(), key=lambda item: -item[1])),
+            "by_file": self.files
+        }
+        return json.dumps(report, indent=2)
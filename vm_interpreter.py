@@ -0,0 +1,282 @@
+"""Runs VM programs directly, as a quick test harness and a reference for the code generator.
+
+Usage: python3 vm_interpreter.py [--reference] PATH...
+PATH is a .tst file or a directory searched for them, as for hack_emulator.py;
+each script runs against the .vm program of its directory. The RAM layout
+matches the translated program's, so the same CPU-emulator scripts and .cmp
+files apply. With --reference the assembled NAME.asm also runs on the CPU
+emulator and any output that differs from the interpreter's is reported.
+"""
+import argparse
+import os
+import sys
+from array import array
+from hack_emulator import RAM_SIZE, WORD, find_tests, run_script, run_test, to_signed
+from hack_assembler import FIRST_VARIABLE_ADDRESS
+from parser import Parser
+from vm_ir import BRANCH_OPS, Opcode, Segment, scoped_label
+from vm_translator import VMTranslator
+
+SP, LCL, ARG, THIS, THAT = range(5)
+TEMP_BASE = 5
+
+# Pre-decoded operations. Pushes and pops come in three addressing modes:
+# a constant, a segment register plus index, or a fixed RAM address (temp, pointer, static)
+(PUSH_CONSTANT, PUSH_SEGMENT, PUSH_ADDRESS, POP_SEGMENT, POP_ADDRESS,
+ ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT,
+ GOTO, IF_GOTO, FUNCTION, CALL, RETURN) = range(19)
+
+ARITHMETIC_CODES = {Opcode.ADD: ADD, Opcode.SUB: SUB, Opcode.NEG: NEG, Opcode.EQ: EQ, Opcode.GT: GT,
+                    Opcode.LT: LT, Opcode.AND: AND, Opcode.OR: OR, Opcode.NOT: NOT}
+SEGMENT_REGISTERS = {Segment.LOCAL: LCL, Segment.ARGUMENT: ARG, Segment.THIS: THIS, Segment.THAT: THAT}
+
+
+class VMInterpreter:
+    """Executes a VM program command by command against an array-backed RAM.
+
+    Commands are decoded once into parallel integer arrays (operation and
+    two operands) with labels, functions and static cells resolved, so the
+    run loop only indexes arrays. Statics get addresses from 16 in order of
+    appearance and the bootstrap pushes the same frame as the translated
+    code. Execution halts at the end of the program, on "label L / goto L",
+    or when the outermost frame returns; cycles counts VM commands.
+    """
+
+    def __init__(self, input_path):
+        translator = VMTranslator(input_path)  # For the file order and bootstrap the translator would use
+        if os.path.isdir(translator.input_path):
+            translator.process_directory(translator.input_path)
+        else:
+            translator.input_files = [translator.input_path]
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        self.ops = array("B")
+        self.first = array("l")  # First operand of each operation
+        self.second = array("l")
+        self.statics = {}  # "File.index" -> RAM address
+        self.labels = {}  # label or function name -> operation index
+        self.jumps = []  # (operation index, label, VM location) resolved once every file is decoded
+        for input_file in translator.input_files:
+            self.decode(input_file)
+        self.resolve_jumps()
+        self.rom_size = len(self.ops)  # Program size, in VM commands
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+        self.depth = 0  # Frames pushed by executed calls
+        self.booted = not translator.bootstrap  # The bootstrap runs on the first run, after the script's RAM setup
+
+    def emit(self, op, first=0, second=0):
+        self.ops.append(op)
+        self.first.append(first)
+        self.second.append(second)
+
+    def decode(self, input_file):
+        """Appends the decoded commands of one .vm file"""
+        filename = os.path.splitext(os.path.basename(input_file))[0]
+        function_name = None  # Labels are local to the function they appear in, as in the translation
+        for command in Parser(input_file).iter_commands():
+            op = command.op
+            location = f"{os.path.basename(input_file)}:{command.line_number}"
+            if op == Opcode.FUNCTION:
+                function_name = command.name
+            name = scoped_label(command.name, function_name) if op in BRANCH_OPS else command.name
+            if op in ARITHMETIC_CODES:
+                self.emit(ARITHMETIC_CODES[op])
+            elif op in (Opcode.PUSH, Opcode.POP):
+                self.decode_push_pop(command, filename, location)
+            elif op == Opcode.LABEL or op == Opcode.FUNCTION:
+                if name in self.labels:
+                    raise ValueError(f"{location}: '{command.name}' is defined twice")
+                self.labels[name] = len(self.ops)
+                if op == Opcode.FUNCTION:
+                    self.emit(FUNCTION, command.index)
+            elif op in (Opcode.GOTO, Opcode.IF_GOTO, Opcode.CALL):
+                self.jumps.append((len(self.ops), name, location))
+                code = {Opcode.GOTO: GOTO, Opcode.IF_GOTO: IF_GOTO, Opcode.CALL: CALL}[op]
+                self.emit(code, 0, command.index or 0)
+            elif op == Opcode.RETURN:
+                self.emit(RETURN)
+
+    def decode_push_pop(self, command, filename, location):
+        segment, index = command.segment, command.index
+        if segment == Segment.CONSTANT:
+            if command.op == Opcode.POP:
+                raise ValueError(f"{location}: cannot pop to the constant segment")
+            self.emit(PUSH_CONSTANT, index & WORD)
+            return
+        if segment in SEGMENT_REGISTERS:
+            self.emit(PUSH_SEGMENT if command.op == Opcode.PUSH else POP_SEGMENT, SEGMENT_REGISTERS[segment], index)
+            return
+        if segment == Segment.TEMP:
+            address = TEMP_BASE + index
+        elif segment == Segment.POINTER:
+            address = THIS + index
+        else:
+            address = self.statics.setdefault(f"{filename}.{index}", FIRST_VARIABLE_ADDRESS + len(self.statics))
+        self.emit(PUSH_ADDRESS if command.op == Opcode.PUSH else POP_ADDRESS, address)
+
+    def resolve_jumps(self):
+        for position, label, location in self.jumps:
+            if label not in self.labels:
+                raise ValueError(f"{location}: unknown label or function '{label}'")
+            self.first[position] = self.labels[label]
+
+    def bootstrap(self):
+        """Sets SP to 256 and calls Sys.init, like VMTranslator.write_bootstrap"""
+        if "Sys.init" not in self.labels:
+            raise ValueError("The program has no Sys.init function")
+        ram = self.ram
+        ram[SP] = 256
+        self.call(self.rom_size, 0)  # Returning from Sys.init runs past the end of the program
+        self.pc = self.labels["Sys.init"]
+
+    def call(self, return_address, n_args):
+        """Pushes a frame like the generated call code; the caller then jumps to the function"""
+        ram = self.ram
+        sp = ram[SP]
+        ram[sp] = return_address
+        ram[sp + 1:sp + 5] = ram[LCL:THAT + 1]
+        ram[ARG] = sp - n_args
+        ram[SP] = ram[LCL] = sp + 5
+        self.depth += 1
+
+    def set_ram(self, address, value):
+        self.ram[address] = value & WORD
+
+    def get_ram(self, address):
+        """Returns a RAM word as a signed integer"""
+        return to_signed(self.ram[address])
+
+    def run(self, max_cycles):
+        """Executes up to max_cycles VM commands and returns the number executed"""
+        if not self.booted:
+            self.booted = True
+            self.bootstrap()
+        ram, ops, first, second = self.ram, self.ops, self.first, self.second
+        pc, size = self.pc, self.rom_size
+        executed = 0
+        while executed < max_cycles and not self.halted:
+            if pc >= size:
+                self.halted = True
+                break
+            executed += 1
+            op = ops[pc]
+            if op == PUSH_CONSTANT:
+                sp = ram[SP]
+                ram[sp] = first[pc]
+                ram[SP] = sp + 1
+            elif op == PUSH_SEGMENT:
+                sp = ram[SP]
+                ram[sp] = ram[(ram[first[pc]] + second[pc]) & 0x7FFF]
+                ram[SP] = sp + 1
+            elif op == PUSH_ADDRESS:
+                sp = ram[SP]
+                ram[sp] = ram[first[pc]]
+                ram[SP] = sp + 1
+            elif op == POP_SEGMENT:
+                sp = ram[SP] - 1
+                ram[(ram[first[pc]] + second[pc]) & 0x7FFF] = ram[sp]
+                ram[SP] = sp
+            elif op == POP_ADDRESS:
+                sp = ram[SP] - 1
+                ram[first[pc]] = ram[sp]
+                ram[SP] = sp
+            elif op <= NOT:
+                sp = ram[SP] - 1
+                y = ram[sp]
+                if op == NEG:
+                    ram[sp] = -y & WORD
+                elif op == NOT:
+                    ram[sp] = ~y & WORD
+                else:
+                    x = ram[sp - 1]
+                    if op == ADD:
+                        value = (x + y) & WORD
+                    elif op == SUB:
+                        value = (x - y) & WORD
+                    elif op == AND:
+                        value = x & y
+                    elif op == OR:
+                        value = x | y
+                    else:
+                        # Comparisons test the sign of the 16-bit difference, like the generated code
+                        difference = (x - y) & WORD
+                        if op == EQ:
+                            value = WORD if difference == 0 else 0
+                        elif op == GT:
+                            value = WORD if 0 < difference < 0x8000 else 0
+                        else:
+                            value = WORD if difference >= 0x8000 else 0
+                    ram[sp - 1] = value
+                    ram[SP] = sp
+            elif op == GOTO:
+                if first[pc] == pc:  # "label L / goto L", the end of the program
+                    self.halted = True
+                    break
+                pc = first[pc]
+                continue
+            elif op == IF_GOTO:
+                sp = ram[SP] - 1
+                ram[SP] = sp
+                if ram[sp]:
+                    pc = first[pc]
+                    continue
+            elif op == FUNCTION:
+                sp = ram[SP]
+                n_vars = first[pc]
+                ram[sp:sp + n_vars] = array("H", bytes(2 * n_vars))
+                ram[SP] = sp + n_vars
+            elif op == CALL:
+                self.call(pc + 1, second[pc])
+                pc = first[pc]
+                continue
+            else:  # RETURN
+                frame = ram[LCL]
+                return_address = ram[frame - 5]
+                arg = ram[ARG]
+                ram[arg] = ram[ram[SP] - 1]
+                ram[SP] = arg + 1
+                ram[THAT], ram[THIS], ram[ARG], ram[LCL] = ram[frame - 1], ram[frame - 2], ram[frame - 3], ram[frame - 4]
+                if self.depth == 0:  # Returning from a frame the test set up, to code outside the program
+                    self.halted = True
+                    break
+                self.depth -= 1
+                pc = return_address
+                continue
+            pc += 1
+        self.pc = pc
+        self.cycles += executed
+        return executed
+
+
+def run_program_test(tst_path):
+    """Runs a CPU-emulator .tst script against the VM program in its directory"""
+    return run_script(tst_path, VMInterpreter(os.path.dirname(os.path.abspath(tst_path))))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("paths", nargs="+", help=".tst files or directories containing them")
+    arg_parser.add_argument("--reference", action="store_true",
+                            help="also run each NAME.asm on the CPU emulator and report outputs that differ")
+    args = arg_parser.parse_args()
+
+    failures = 0
+    print(f"{'test':<20}{'result':>8}{'commands':>10}{'steps':>10}")
+    for tst_path in find_tests(args.paths):
+        result = run_program_test(tst_path)
+        steps = f"{result.cycles}" + ("" if result.halted else "+")  # + : still running at the step bound
+        print(f"{result.name:<20}{'ok' if result.passed else 'FAIL':>8}{result.rom_size:>10}{steps:>10}")
+        if not result.passed:
+            failures += 1
+            print(f"  got {result.outputs}, expected {result.expected}")
+        if args.reference:
+            emulated = run_test(tst_path)
+            if emulated.outputs != result.outputs:
+                failures += 1
+                print(f"  {result.name}.asm differs: got {emulated.outputs}, interpreter {result.outputs}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+from enum import Enum
+
+
+class Opcode(Enum):
+    """VM command opcodes, valued by their VM keyword"""
+    ADD = "add"
+    SUB = "sub"
+    NEG = "neg"
+    EQ = "eq"
+    GT = "gt"
+    LT = "lt"
+    AND = "and"
+    OR = "or"
+    NOT = "not"
+    PUSH = "push"
+    POP = "pop"
+    LABEL = "label"
+    GOTO = "goto"
+    IF_GOTO = "if-goto"
+    IF_NOT_GOTO = "if-not-goto"  # Jumps when the popped value is false, produced by the control-flow pass only
+    FUNCTION = "function"
+    CALL = "call"
+    RETURN = "return"
+    MOVE = "move"  # Fused "push X / pop Y", produced by the optimiser only
+    TAIL_CALL = "tail-call"  # "call f n" directly followed by "return", produced by the call optimiser only
+    DROP = "drop"  # Discards the top index stack values, produced by the call optimiser only
+
+
+class Segment(Enum):
+    """VM memory segments, valued by their VM keyword"""
+    CONSTANT = "constant"
+    LOCAL = "local"
+    ARGUMENT = "argument"
+    THIS = "this"
+    THAT = "that"
+    TEMP = "temp"
+    POINTER = "pointer"
+    STATIC = "static"
+    STACK = "stack"  # Cell index places below the stack top, produced by the call optimiser only
+
+
+ARITHMETIC_OPS = frozenset([
+    Opcode.ADD, Opcode.SUB, Opcode.NEG, Opcode.EQ, Opcode.GT,
+    Opcode.LT, Opcode.AND, Opcode.OR, Opcode.NOT
+])
+UNARY_OPS = frozenset([Opcode.NEG, Opcode.NOT])
+BRANCH_OPS = frozenset([Opcode.LABEL, Opcode.GOTO, Opcode.IF_GOTO, Opcode.IF_NOT_GOTO])
+# What a .vm file may contain; the other opcodes and segments only come out of the optimisation passes
+SOURCE_OPS = frozenset(Opcode) - {Opcode.IF_NOT_GOTO, Opcode.MOVE, Opcode.TAIL_CALL, Opcode.DROP}
+SOURCE_SEGMENTS = frozenset(Segment) - {Segment.STACK}
+# Fewest locals for which CodeWriter's zeroing loop (9 instructions) is smaller than the unrolled
+# prologue (5 instructions per local, 4 once the peephole pass has run); the --prologue-loop and -Os default
+PROLOGUE_LOOP_MIN_LOCALS = 3
+
+
+def scoped_label(label, function_name):
+    """Returns the program-wide name of a VM label, which is local to its function (if any)"""
+    return f"{function_name}${label}" if function_name else label
+
+
+def to_signed16(value):
+    """Wraps an integer to a Hack 16-bit two's complement word"""
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def evaluate_arithmetic(op, x, y=None):
+    """Computes an arithmetic command the way the generated Hack code does.
+
+    x is the deeper stack operand (the only one for neg/not). Comparisons
+    test the sign of the 16-bit difference x - y, like writeArithmetic.
+    """
+    if op == Opcode.NEG:
+        return to_signed16(-x)
+    if op == Opcode.NOT:
+        return to_signed16(~x)
+    if op == Opcode.ADD:
+        return to_signed16(x + y)
+    if op == Opcode.SUB:
+        return to_signed16(x - y)
+    if op == Opcode.AND:
+        return to_signed16(x & y)
+    if op == Opcode.OR:
+        return to_signed16(x | y)
+    difference = to_signed16(x - y)
+    if op == Opcode.EQ:
+        return -1 if difference == 0 else 0
+    if op == Opcode.GT:
+        return -1 if difference > 0 else 0
+    if op == Opcode.LT:
+        return -1 if difference < 0 else 0
+    raise ValueError(f"Not an arithmetic command: {op}")
+
+
+class Command:
+    """A single parsed VM command.
+
+    push/pop use segment and index, label/goto/if-goto use name,
+    function/call/tail-call use name and index (nVars/nArgs). move reads
+    segment and index and writes target_segment and target_index. Static
+    cells of another file (inlined code) carry that file in name.
+    """
+    __slots__ = ("op", "segment", "index", "name", "line_number", "target_segment", "target_index")
+
+    def __init__(self, op, segment=None, index=None, name=None, line_number=0,
+                 target_segment=None, target_index=None):
+        self.op = op
+        self.segment = segment
+        self.index = index
+        self.name = name
+        self.line_number = line_number  # 1-based line in the source .vm file
+        self.target_segment = target_segment
+        self.target_index = target_index
+
+    def _key(self):
+        return self.op, self.segment, self.index, self.name, self.target_segment, self.target_index
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"Command({self})"
+
+    def __str__(self):
+        """Returns the command in VM syntax"""
+        if self.op in (Opcode.PUSH, Opcode.POP):
+            return f"{self.op.value} {self.segment.value} {self.index}"
+        if self.op == Opcode.MOVE:
+            return f"move {self.segment.value} {self.index} {self.target_segment.value} {self.target_index}"
+        if self.op == Opcode.DROP:
+            return f"drop {self.index}"
+        if self.op in (Opcode.FUNCTION, Opcode.CALL, Opcode.TAIL_CALL):
+            return f"{self.op.value} {self.name} {self.index}"
+        if self.op in BRANCH_OPS:
+            return f"{self.op.value} {self.name}"
+        return self.op.value
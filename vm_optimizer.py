@@ -0,0 +1,65 @@
+from vm_ir import Command, Opcode, Segment, ARITHMETIC_OPS, UNARY_OPS, evaluate_arithmetic
+
+
+def is_push_constant(command):
+    return command.op == Opcode.PUSH and command.segment == Segment.CONSTANT
+
+
+class VMOptimizer:
+    """Rewrites a file's Commands before code generation.
+
+    Folds arithmetic on constants into a single push, and fuses
+    "push X / pop Y" into a move that never touches the stack. Both
+    rewrites stream: they only hold back the commands they may still fold.
+    """
+
+    def __init__(self):
+        self.applied = {"fold": 0, "fuse": 0}  # Commands removed by each rewrite
+
+    def fold_constants(self, commands):
+        """Replaces constant operands followed by an arithmetic command with their result"""
+        constants = []  # Trailing run of "push constant" commands, not yet emitted
+        for command in commands:
+            if command.op in ARITHMETIC_OPS:
+                operands = 1 if command.op in UNARY_OPS else 2
+                if len(constants) >= operands:
+                    values = [c.index for c in constants[-operands:]]
+                    first = constants[-operands]
+                    del constants[-operands:]
+                    constants.append(Command(Opcode.PUSH, Segment.CONSTANT, evaluate_arithmetic(command.op, *values),
+                                             line_number=first.line_number))
+                    self.applied["fold"] += operands
+                    continue
+            if is_push_constant(command):
+                constants.append(command)
+                continue
+            yield from constants
+            constants = []
+            yield command
+        yield from constants
+
+    def fuse_push_pop(self, commands):
+        """Replaces each "push X / pop Y" pair with a single move"""
+        previous = None  # A push that may still be fused with the next command
+        for command in commands:
+            # Both cells of a move share one static scope
+            if previous is not None and command.op == Opcode.POP and previous.name == command.name:
+                yield Command(Opcode.MOVE, previous.segment, previous.index, name=previous.name,
+                              line_number=previous.line_number,
+                              target_segment=command.segment, target_index=command.index)
+                self.applied["fuse"] += 1
+                previous = None
+                continue
+            if previous is not None:
+                yield previous
+            previous = command if command.op == Opcode.PUSH else None
+            if previous is None:
+                yield command
+        if previous is not None:
+            yield previous
+
+    def report(self):
+        """Returns one line per rewrite with the number of VM commands it removed"""
+        lines = [f"{name:<16}{removed:>8}" for name, removed in self.applied.items()]
+        lines.append(f"{'total':<16}{sum(self.applied.values()):>8}")
+        return "\n".join(lines)
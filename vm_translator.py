@@ -1,15 +1,127 @@
 from parser import Parser
 from code_writer import CodeWriter
+from hack_assembler import OUTPUT_FORMATS
+from vm_ir import Opcode, Segment, ARITHMETIC_OPS
+from vm_optimizer import VMOptimizer
+from call_optimizer import CallOptimizer, INLINE_THRESHOLD, inlinable
+from control_flow import ControlFlowOptimizer
+from peephole import Peephole
+from pass_manager import PassManager, PASSES, is_instruction
+from translation_stats import TranslationStats, WRITER_METHODS
+from profiler import profile_layout, profile_map_path
+from translation_cache import TranslationCache, MemoryCache, CACHE_DIR_NAME
+from call_graph import CallGraph, drop_dead_functions, split_functions
+from collections import namedtuple
+import json
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from time import perf_counter
 import os
 import sys
 
 
+# Assembly of one translated unit, plus what it needs from (and reports to) the linked program
+Fragment = namedtuple("Fragment", ["lines", "routines", "vm_optimized", "calls_optimized", "jumps_optimized",
+                                   "peephole_removed", "pass_stats", "stats"])
+
+BOOTSTRAP_SCOPE = "$bootstrap"  # Label scope of the bootstrap code, cannot clash with a .vm file name
+
+
+def translate_fragment(input_file, options):
+    """Translates one .vm file into a self-contained Fragment (runs in worker processes)"""
+    translator = VMTranslator(input_file, **options)
+    translator.code_writer = translator.fragment_writer()
+    translator.translate_file(input_file)
+    return translator.finish_fragment()
+
+
 class VMTranslator:
 
-    def __init__(self, input_path):
+    def __init__(self, input_path, shared_calls=False, peephole=False, vm_optimize=False, shared_compare=False,
+                 jobs=1, cache=False, dead_functions=False, live_functions=None, tos_cache=False,
+                 tail_calls=False, inline_threshold=0, inline_functions=None, passes=None, stats=False,
+                 profile=False, profile_calls=False, profile_layout=None, output_format="asm", thread_jumps=False,
+                 prologue_loop=0, memory_cache=None, segment_cache=False, source_map=False):
         self.input_path = input_path.rstrip('/')
+        self.shared_calls = shared_calls
+        self.shared_compare = shared_compare
+        self.tos_cache = tos_cache
+        self.prologue_loop = prologue_loop  # Zero the locals of functions with at least this many in a loop
+        self.segment_cache = segment_cache  # Reuse segment addresses and values left in A, D and R13
+        self.source_map = source_map  # Write a source_map.SourceMap of the output next to it
+        self.jobs = jobs
+        self.use_cache = cache
+        self.cache = None  # TranslationCache of the output's directory, set up by translate
+        self.memory_cache = memory_cache  # Entries of a MemoryCache kept between translations, instead of the disk
+
+        # Transformation passes to run, in order; by default the ones the options turn on
+        if passes is None:
+            enabled = {"dead-functions": dead_functions, "inline": bool(inline_threshold or inline_functions),
+                       "tail-calls": tail_calls, "jumps": thread_jumps, "fold": vm_optimize, "fuse": vm_optimize, "peephole": peephole}
+            passes = [name for name in PASSES if enabled[name]]
+        unknown = [name for name in passes if name not in PASSES]
+        if unknown:
+            raise ValueError(f"Unknown passes: {', '.join(unknown)} (known passes: {', '.join(PASSES)})")
+        self.passes = list(passes)
+
+        self.dead_functions = "dead-functions" in self.passes  # Find and drop functions unreachable from the entry
+        self.live_functions = frozenset(live_functions) if live_functions is not None else None
+        self.dead_function_report = []
+        # Inline leaf functions whose body is at most this many instructions
+        self.inline_threshold = (inline_threshold or INLINE_THRESHOLD) if "inline" in self.passes else 0
+        self.inline_functions = inline_functions  # Found by find_inline_functions, see CallOptimizer
+        self.vm_optimizer = VMOptimizer() if {"fold", "fuse"} & set(self.passes) else None
+        self.call_optimizer = CallOptimizer(inline_functions) if {"inline", "tail-calls"} & set(self.passes) else None
+        self.control_flow = ControlFlowOptimizer() if "jumps" in self.passes else None
+        self.peephole = Peephole() if "peephole" in self.passes else None
+        self.pass_manager = self.build_pass_manager()
+        self.stats = TranslationStats() if stats else None  # Stage timings and instruction counts for --stats
+        self.current_function = None  # Function the commands being written belong to
+        self.profile = profile or profile_calls  # Count function entries (and calls with profile_calls) in RAM
+        self.profile_calls = profile_calls
+        self.profile_layout = profile_layout  # Counter addresses, see profiler.profile_layout
+        self.output_format = output_format  # Key of code_writer.OUTPUT_FORMATS
         self.code_writer = None
         self.input_files = []
+        self.output_file = None
+        self.bootstrap = False
+
+    def options(self):
+        """Returns the code generation options, as passed to worker processes"""
+        return {
+            "shared_calls": self.shared_calls,
+            "shared_compare": self.shared_compare,
+            "tos_cache": self.tos_cache,
+            "prologue_loop": self.prologue_loop,
+            "segment_cache": self.segment_cache,
+            "source_map": self.source_map,
+            "passes": self.passes,
+            "live_functions": sorted(self.live_functions) if self.live_functions is not None else None,
+            "inline_functions": self.inline_functions,
+            "stats": self.stats is not None,
+            "profile_layout": self.profile_layout
+        }
+
+    def build_pass_manager(self):
+        """Returns a PassManager that runs this translator's passes in order"""
+        vm_passes = {
+            "dead-functions": lambda commands: drop_dead_functions(commands, self.live_functions),
+            "inline": lambda commands: self.call_optimizer.inline_calls(commands, self.code_writer.filename),
+            "tail-calls": lambda commands: self.call_optimizer.mark_tail_calls(commands),
+            "jumps": lambda commands: self.control_flow.optimize(commands),
+            "fold": lambda commands: self.vm_optimizer.fold_constants(commands),
+            "fuse": lambda commands: self.vm_optimizer.fuse_push_pop(commands)
+        }
+        assembly_passes = {
+            "peephole": lambda lines: self.peephole.optimize(lines)
+        }
+        pass_manager = PassManager()
+        for name in self.passes:
+            if name in vm_passes:
+                pass_manager.add_vm_pass(name, vm_passes[name])
+            else:
+                pass_manager.add_assembly_pass(name, assembly_passes[name])
+        return pass_manager
 
     def process_directory(self, dir_path):
         # Get directory name for output file name
@@ -26,36 +138,27 @@ class VMTranslator:
             raise ValueError(f"No .vm files found in {dir_path}")
 
         # Create output file with directory name
-        output_file = os.path.join(dir_path, f"{dir_name}.asm")
-        self.code_writer = CodeWriter(output_file)
+        self.output_file = os.path.join(dir_path, f"{dir_name}{OUTPUT_FORMATS[self.output_format]}")
 
         # If only one VM file, just translate it without bootstrap
         if len(self.input_files) == 1:
-            self.translate_file(self.input_files[0])
             return
 
         # For multiple files, check if Sys.vm exists
-        sys_vm_exists = any(f.endswith('Sys.vm') for f in self.input_files)
+        sys_files = [f for f in self.input_files if os.path.basename(f) == 'Sys.vm']
 
         # If multiple files and Sys.vm exists, write bootstrap ONCE at the start
-        if sys_vm_exists:
-            self.write_bootstrap()
+        self.bootstrap = bool(sys_files)
 
-        # Translate all files (Sys.vm first if it exists)
-        if sys_vm_exists:
-            # Find and translate Sys.vm first
-            sys_file = next(f for f in self.input_files if f.endswith('Sys.vm'))
-            self.translate_file(sys_file)
-            remaining_files = [f for f in self.input_files if f != sys_file]
-        else:
-            remaining_files = self.input_files
-
-        # Translate remaining files
-        for vm_file in sorted(remaining_files):
-            self.translate_file(vm_file)
+        # Translate all files (Sys.vm first if it exists), remaining files in sorted order
+        remaining_files = [f for f in self.input_files if f not in sys_files]
+        self.input_files = sys_files + sorted(remaining_files)
 
     def write_bootstrap(self):
         """Writes bootstrap code that sets SP=256 and calls Sys.init"""
+        self.code_writer.setFileName(BOOTSTRAP_SCOPE)
+        if self.source_map:
+            self.code_writer.mark_source(BOOTSTRAP_SCOPE, 0, None)
         self.code_writer.write_lines([
             "// Bootstrap code",
             "@256",
@@ -67,64 +170,303 @@ class VMTranslator:
         self.code_writer.writeCall("Sys.init", 0)
 
     def translate(self):
+        started = perf_counter()
         if os.path.isdir(self.input_path):
             self.process_directory(self.input_path)
         else:
             # Single file case
             self.input_files = [self.input_path]
-            self.code_writer = CodeWriter(self.input_path.replace('.vm', '.asm'))
-            self.translate_file(self.input_path)
-        if self.code_writer:
-            self.code_writer.close()
+            self.output_file = self.input_path.replace('.vm', OUTPUT_FORMATS[self.output_format])
+        if self.stats:
+            self.stats.add_time("directory scan", perf_counter() - started)
+
+        # Whole-program analyses, timed as part of the pass that needs them
+        if self.dead_functions:
+            start = perf_counter()
+            self.find_live_functions()
+            self.pass_manager.add_time("dead-functions", perf_counter() - start)
+
+        if self.inline_threshold:
+            start = perf_counter()
+            self.find_inline_functions()
+            self.pass_manager.add_time("inline", perf_counter() - start)
+
+        if self.profile:
+            self.find_profile_counters()
+
+        if self.memory_cache is not None:
+            self.cache = MemoryCache(self.memory_cache, self.options())
+        elif self.use_cache:
+            cache_dir = os.path.join(os.path.dirname(self.output_file), CACHE_DIR_NAME)
+            self.cache = TranslationCache(cache_dir, self.options())
+
+        self.code_writer = self.new_code_writer(self.output_file, True)
+        if self.bootstrap:
+            start = perf_counter()
+            self.write_bootstrap()
+            if self.stats:
+                self.stats.record("bootstrap", "writeCall", None, BOOTSTRAP_SCOPE, perf_counter() - start,
+                                  self.code_writer.instructions)
+
+        if self.jobs > 1 or self.cache:
+            for fragment in self.translate_fragments():
+                self.link(fragment)
+        else:
+            # Stream every file straight into the output
+            for input_file in self.input_files:
+                self.translate_file(input_file)
+        self.code_writer.close()
+
+        if self.stats:
+            self.stats.add_time("flush", self.code_writer.flush_seconds)
+            self.stats.add_time("total", perf_counter() - started)
+
+    def stats_report(self):
+        """Returns the --stats JSON report of the finished translation"""
+        if self.code_writer.assembler:
+            output_instructions = len(self.code_writer.assembler.words)
+        else:
+            with open(self.output_file) as output:
+                output_instructions = sum(1 for line in output if is_instruction(line))
+        return self.stats.report(
+            input=self.input_path,
+            output=self.output_file,
+            files=[os.path.basename(f) for f in self.input_files],
+            passes=self.passes,
+            pass_timings_ms={name: round(entry["seconds"] * 1000, 3) for name, entry in self.pass_manager.stats.items()},
+            output_instructions=output_instructions
+        )
+
+    def find_live_functions(self):
+        """Builds the whole program's call graph and keeps the functions reachable from its entry point"""
+        call_graph = CallGraph()
+        for input_file in self.input_files:
+            call_graph.add_file(input_file, Parser(input_file).iter_commands())
+
+        # The bootstrap enters at Sys.init, otherwise execution starts at the first function
+        roots = set(call_graph.top_level_calls)
+        if self.bootstrap:
+            roots.add("Sys.init")
+        elif call_graph.entry_points:
+            roots.add(call_graph.entry_points[0])
+        self.live_functions = frozenset(call_graph.reachable(roots))
+
+        # Measure what the dropped functions would have cost
+        dead_files = sorted({f for name, f in call_graph.files.items() if name not in self.live_functions})
+        total_words = 0
+        for input_file in dead_files:
+            writer = self.new_code_writer(None, False)
+            writer.setFileName(os.path.basename(input_file).replace('.vm', ''))
+            self.code_writer = writer
+            words = {}
+            for function_name, command in split_functions(Parser(input_file).iter_commands()):
+                if function_name is None or function_name in self.live_functions:
+                    continue
+                before = len(writer.pending_lines)
+                self.write_command(command)
+                words[function_name] = words.get(function_name, 0) + sum(
+                    1 for line in writer.pending_lines[before:] if is_instruction(line))
+            for function_name, count in words.items():
+                self.dead_function_report.append(
+                    f"dropped {function_name} ({os.path.basename(input_file)}): {count} words")
+                total_words += count
+        self.dead_function_report.append(
+            f"{len(self.dead_function_report)} unreachable functions dropped, {total_words} ROM words saved")
+
+    def find_inline_functions(self):
+        """Picks the leaf functions whose body translates to at most inline_threshold instructions"""
+        self.inline_functions = {}
+        for input_file in self.input_files:
+            filename = os.path.basename(input_file).replace('.vm', '')
+            functions = {}
+            for function_name, command in split_functions(Parser(input_file).iter_commands()):
+                if function_name is not None:
+                    functions.setdefault(function_name, []).append(command)
+            for function_name, function in functions.items():
+                if not inlinable(function):
+                    continue
+                writer = self.new_code_writer(None, False)
+                writer.setFileName(filename)
+                self.code_writer = writer
+                for command in function[1:-1]:
+                    self.write_command(command)
+                writer.spill()
+                if sum(1 for line in writer.pending_lines if is_instruction(line)) > self.inline_threshold:
+                    continue
+                self.inline_functions[function_name] = {
+                    "file": filename,
+                    "locals": function[0].index,
+                    "arguments": max([c.index + 1 for c in function if c.segment == Segment.ARGUMENT], default=0),
+                    "body": [str(command) for command in function[1:-1]]
+                }
+        self.call_optimizer.inline_functions = self.inline_functions
+
+    def find_profile_counters(self):
+        """Reserves a RAM counter per function (and call site) and writes their symbol map next to the output"""
+        functions, call_sites, statics = [], [], set()
+        for input_file in self.input_files:
+            filename = os.path.splitext(os.path.basename(input_file))[0]
+            for function_name, command in split_functions(Parser(input_file).iter_commands()):
+                if command.segment == Segment.STATIC:
+                    statics.add(f"{filename}.{command.index}")
+                elif command.op == Opcode.FUNCTION:
+                    functions.append(command.name)
+                elif command.op == Opcode.CALL and self.profile_calls:
+                    call_sites.append((f"{os.path.basename(input_file)}:{command.line_number}",
+                                       function_name, command.name))
+        self.profile_layout = profile_layout(functions, call_sites, len(statics))
+        with open(profile_map_path(self.output_file), 'w') as profile_map:
+            json.dump(self.profile_layout, profile_map, indent=2)
+
+    def counter(self, command):
+        """Returns the RAM address counting a function's entries or a call site's calls, if profiled"""
+        if not self.profile_layout:
+            return None
+        if command.op == Opcode.FUNCTION:
+            return self.profile_layout["functions"].get(command.name)
+        site = self.profile_layout["call_sites"].get(f"{self.code_writer.filename}.vm:{command.line_number}")
+        return site["address"] if site else None
+
+    def translate_fragments(self):
+        """Translates every input file into a Fragment, in output order"""
+        # Unchanged files are spliced in from the cache, only the rest are translated
+        cached = {}
+        if self.cache:
+            keys = {f: self.cache.key(f) for f in self.input_files}
+            for input_file in self.input_files:
+                fields = self.cache.get(input_file, keys[input_file])
+                if fields is not None:
+                    cached[input_file] = Fragment(**fields)
+        pending_files = [f for f in self.input_files if f not in cached]
+
+        if self.jobs > 1 and len(pending_files) > 1:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                translated = list(executor.map(translate_fragment, pending_files, repeat(self.options())))
+        else:
+            translated = [translate_fragment(f, self.options()) for f in pending_files]
+
+        for input_file, fragment in zip(pending_files, translated):
+            cached[input_file] = fragment
+            if self.cache:
+                self.cache.put(keys[input_file], fragment._asdict())
+
+        return [cached[f] for f in self.input_files]
+
+    def new_code_writer(self, output_path, optimize):
+        """Returns a CodeWriter with this translator's code generation options (and assembly passes if optimize)"""
+        optimizer = self.pass_manager if optimize and self.pass_manager.assembly_passes else None
+        return CodeWriter(output_path, shared_calls=self.shared_calls, optimizer=optimizer,
+                          shared_compare=self.shared_compare, tos_cache=self.tos_cache,
+                          prologue_loop=self.prologue_loop, segment_cache=self.segment_cache,
+                          source_map=self.source_map,
+                          count_instructions=self.stats is not None, output_format=self.output_format)
+
+    def fragment_writer(self):
+        """Returns a CodeWriter that keeps its assembly in memory"""
+        return self.new_code_writer(None, True)
+
+    def finish_fragment(self):
+        """Collects the current in-memory CodeWriter's output into a Fragment"""
+        return Fragment(
+            lines=self.code_writer.fragment(),
+            routines=self.code_writer.used_routines,
+            vm_optimized=dict(self.vm_optimizer.applied) if self.vm_optimizer else {},
+            calls_optimized=dict(self.call_optimizer.applied) if self.call_optimizer else {},
+            jumps_optimized=dict(self.control_flow.applied) if self.control_flow else {},
+            peephole_removed=dict(self.peephole.removed) if self.peephole else {},
+            pass_stats=self.pass_manager.stats,
+            stats=self.stats.as_dict() if self.stats else None
+        )
+
+    def link(self, fragment):
+        """Appends a Fragment to the output and records the shared routines and statistics it carries"""
+        self.code_writer.write_fragment(fragment.lines)
+        for routine in fragment.routines:
+            self.code_writer.use_routine(routine)
+        if self.vm_optimizer:
+            for name, removed in fragment.vm_optimized.items():
+                self.vm_optimizer.applied[name] += removed
+        if self.call_optimizer:
+            for name, count in fragment.calls_optimized.items():
+                self.call_optimizer.applied[name] += count
+        if self.control_flow:
+            for name, count in fragment.jumps_optimized.items():
+                self.control_flow.applied[name] += count
+        if self.peephole:
+            for name, removed in fragment.peephole_removed.items():
+                self.peephole.removed[name] += removed
+        self.pass_manager.merge(fragment.pass_stats)
+        if self.stats and fragment.stats:
+            self.stats.merge(fragment.stats)
 
     def translate_file(self, input_file):
         """Translates a single VM file"""
         # Set filename for static variable handling (removing .vm extension)
-        self.code_writer.filename = os.path.basename(input_file).replace('.vm', '')
+        self.code_writer.setFileName(os.path.basename(input_file).replace('.vm', ''))
 
         # Add comment to mark start of new VM file translation
         self.code_writer.write_lines([f"\n// Translating file: {self.code_writer.filename}"])
 
-        parser = Parser(input_file)
+        commands = Parser(input_file).iter_commands()
+        if self.stats:
+            commands = self.stats.timed("parse", commands)
+        self.current_function = None
+        for command in self.pass_manager.run_vm(commands):
+            if self.stats:
+                self.write_measured(command)
+            else:
+                self.write_command(command)
+
+    def write_measured(self, command):
+        """Writes a single Command, recording its code generation time and instruction count"""
+        before = self.code_writer.instructions
+        start = perf_counter()
+        self.write_command(command)
+        self.stats.record(command.op.value, WRITER_METHODS[command.op], self.current_function,
+                          self.code_writer.filename, perf_counter() - start, self.code_writer.instructions - before)
+
+    def write_command(self, command):
+        """Dispatches a single parsed Command to the CodeWriter"""
+        op = command.op
+        if op == Opcode.FUNCTION:
+            self.current_function = command.name  # Scopes labels, and attributes the stats and source map
+        if self.source_map:
+            self.code_writer.mark_source(f"{self.code_writer.filename}.vm", command.line_number,
+                                         self.current_function)
+
+        if op in ARITHMETIC_OPS:
+            self.code_writer.writeArithmetic(op.value)
+
+        elif op in (Opcode.PUSH, Opcode.POP):
+            self.code_writer.writePushPop(op.value, command.segment.value, command.index, command.name)
 
-        while parser.hasMoreLines():
-            parser.advance()
-            if not parser.line:  # Skip empty lines
-                continue
+        elif op == Opcode.MOVE:
+            self.code_writer.writeMove(command.segment.value, command.index,
+                                       command.target_segment.value, command.target_index, command.name)
 
-            command_type = parser.command_type()
+        elif op == Opcode.DROP:
+            self.code_writer.writeDrop(command.index)
 
-            if command_type == parser.C_ARITHMETIC:
-                command = parser.arg1()
-                self.code_writer.writeArithmetic(command)
+        elif op == Opcode.LABEL:
+            self.code_writer.writeLabel(command.name, self.current_function)
 
-            elif command_type in [parser.C_PUSH, parser.C_POP]:
-                command = "push" if command_type == parser.C_PUSH else "pop"
-                segment = parser.arg1()
-                index = parser.arg2()
-                self.code_writer.writePushPop(command, segment, index)
+        elif op == Opcode.GOTO:
+            self.code_writer.writeGoto(command.name, self.current_function)
 
-            elif command_type == parser.C_LABEL:
-                label = parser.arg1()
-                self.code_writer.writeLabel(label)
+        elif op == Opcode.IF_GOTO:
+            self.code_writer.writeIf(command.name, function_name=self.current_function)
 
-            elif command_type == parser.C_GOTO:
-                label = parser.arg1()
-                self.code_writer.writeGoto(label)
+        elif op == Opcode.IF_NOT_GOTO:
+            self.code_writer.writeIf(command.name, when_false=True, function_name=self.current_function)
 
-            elif command_type == parser.C_IF:
-                label = parser.arg1()
-                self.code_writer.writeIf(label)
+        elif op == Opcode.FUNCTION:
+            self.code_writer.writeFunction(command.name, command.index, self.counter(command))
 
-            elif command_type == parser.C_FUNCTION:
-                function_name = parser.arg1()
-                num_locals = parser.arg2()
-                self.code_writer.writeFunction(function_name, num_locals)
+        elif op == Opcode.RETURN:
+            self.code_writer.writeReturn()
 
-            elif command_type == parser.C_RETURN:
-                self.code_writer.writeReturn()
+        elif op == Opcode.CALL:
+            self.code_writer.writeCall(command.name, command.index, self.counter(command))
 
-            elif command_type == parser.C_CALL:
-                function_name = parser.arg1()
-                num_args = parser.arg2()
-                self.code_writer.writeCall(function_name, num_args)
\ No newline at end of file
+        elif op == Opcode.TAIL_CALL:
+            self.code_writer.writeTailCall(command.name, command.index, self.counter(command))